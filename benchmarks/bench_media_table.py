@@ -0,0 +1,105 @@
+import argparse
+import asyncio
+import time
+import tracemalloc
+
+from models import CanonMediaEntrySchema
+from queries import STREAM_BATCH_SIZE
+from render import TABLE_HEAD, render_filter_form, render_media_table
+
+SIZES = [1_000, 10_000, 100_000]
+QUERY_STRING = "content_type=TV&watched=false"
+TYPES = ["A", "C", "F", "JR", "N", "P", "SS", "TV", "VG", "YR"]
+
+
+def make_rows(count):
+    return [
+        CanonMediaEntrySchema(
+            id=i,
+            year=f"{i} ABY",
+            year_html=f'<a href="https://starwars.fandom.com/wiki/{i}_ABY">{i} ABY</a>',
+            content_type=TYPES[i % len(TYPES)],
+            content_type_html=TYPES[i % len(TYPES)],
+            title=f"Title {i}",
+            episode_title=f"Episode {i}",
+            episode_url=f"https://starwars.fandom.com/wiki/Episode_{i}",
+            title_html=f'<i><a href="https://starwars.fandom.com/wiki/Title_{i}">Title {i}</a></i>',
+            released="2020-01-01",
+            released_html="2020-01-01",
+            watched=i % 3 == 0,
+            season="S01",
+            episode="E01",
+        )
+        for i in range(count)
+    ]
+
+
+def legacy_render(rows, query_str):
+    # The pre-template /media/table body: one growing string, with the query
+    # string and action URL rebuilt for every row.
+    table_html = render_filter_form(TYPES, [], None, None, None) + TABLE_HEAD
+    for m in rows:
+        action_url = f"/media/{m.id}/watched"
+        if query_str:
+            action_url += f"?{query_str}"
+        table_html += f"<tr><td>{m.id}</td>"
+        table_html += f"<td>{m.year_html if m.year_html else m.year}</td>"
+        table_html += (
+            f"<td>{m.content_type_html if m.content_type_html else m.content_type}</td>"
+        )
+        table_html += f"<td>{m.title_html if m.title_html else m.title}{f' -- {m.episode_title}' if not m.title_html and m.episode_title else ''}</td>"
+        table_html += f"<td>{m.season}</td>"
+        table_html += f"<td>{m.episode}</td>"
+        table_html += f"<td>{m.released_html if m.released_html else m.released}</td>"
+        table_html += f"<td>{'Yes' if m.watched else 'No'}</td>"
+        table_html += f"<td><form method='post' action='{action_url}'><input type='hidden' name='watched' value='{str(not m.watched).lower()}'><button type='submit'>{'Mark Unwatched' if m.watched else 'Mark Watched'}</button></form></td></tr>"
+    table_html += "</table>"
+    return len(table_html)
+
+
+async def _batches(rows):
+    for start in range(0, len(rows), STREAM_BATCH_SIZE):
+        yield rows[start : start + STREAM_BATCH_SIZE]
+
+
+async def _drain(rows, query_str):
+    # Chunks are discarded as they are produced, as a socket write would
+    total = 0
+    form_html = render_filter_form(TYPES, [], None, None, None)
+    async for chunk in render_media_table(form_html, _batches(rows), query_str):
+        total += len(chunk)
+    return total
+
+
+def streamed_render(rows, query_str):
+    return asyncio.run(_drain(rows, query_str))
+
+
+def measure(render, rows):
+    tracemalloc.start()
+    started = time.perf_counter()
+    size = render(rows, QUERY_STRING)
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark /media/table rendering")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    args = parser.parse_args()
+    print(
+        f"{'rows':>8} {'renderer':>9} {'time (ms)':>10} {'peak (KiB)':>11} {'bytes':>12}"
+    )
+    for count in args.sizes:
+        rows = make_rows(count)
+        for name, render in (("before", legacy_render), ("after", streamed_render)):
+            elapsed, peak, size = measure(render, rows)
+            print(
+                f"{count:>8} {name:>9} {elapsed * 1000:>10.1f} {peak / 1024:>11.0f} {size:>12}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+import argparse
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+
+from media_parsers import PARSERS
+
+
+def make_export(source: str, repeat: int) -> str:
+    # Repeats the table body to simulate a larger export
+    with open(source, encoding="utf-8") as f:
+        html = f.read()
+    head, _, rest = html.partition("<tbody>")
+    body, _, tail = rest.partition("</tbody>")
+    fd, path = tempfile.mkstemp(suffix=".html")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        f.write(head + "<tbody>" + body * repeat + "</tbody>" + tail)
+    return path
+
+
+def _run(name, path, queue):
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.perf_counter()
+    rows = list(PARSERS[name](path))
+    elapsed = time.perf_counter() - started
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline
+    queue.put((elapsed, peak, rows))
+
+
+def measure(name, path):
+    # Each parser runs in a fresh process so peak RSS is not shared
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run, args=(name, path, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark media_table.html parsers")
+    parser.add_argument("path", nargs="?", default="media_table.html")
+    parser.add_argument("--repeat", type=int, nargs="+", default=[1, 10])
+    args = parser.parse_args()
+    print(
+        f"{'repeat':>6} {'parser':>6} {'rows':>8} {'time (s)':>9} {'peak RSS (MiB)':>15}"
+    )
+    for repeat in args.repeat:
+        path = args.path if repeat == 1 else make_export(args.path, repeat)
+        try:
+            results = {name: measure(name, path) for name in PARSERS}
+        finally:
+            if path != args.path:
+                os.remove(path)
+        outputs = [rows for _, _, rows in results.values()]
+        if any(rows != outputs[0] for rows in outputs[1:]):
+            raise SystemExit("Parser outputs differ")
+        for name, (elapsed, peak, rows) in results.items():
+            print(
+                f"{repeat:>6} {name:>6} {len(rows):>8} {elapsed:>9.2f} {peak / 1024:>15.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+import argparse
+import random
+import time
+
+from sqlalchemy import create_engine, insert, select
+
+from models import Base, CanonMediaEntry, MediaFilter
+from queries import media_query
+
+SIZES = [10_000, 100_000]
+SYLLABLES = "an dor jed ka lo man no rey sith ta vo wan".split()
+# ~1,500 made-up words keep each term about as selective as a real
+# title word; the searches below hit one word, two words and a prefix.
+WORDS = sorted(
+    {
+        "".join(random.Random(i).choices(SYLLABLES, k=3)).capitalize()
+        for i in range(4000)
+    }
+)
+SEARCHES = [WORDS[100], f"{WORDS[200]} {WORDS[300]}", WORDS[400][:4], "nomatch"]
+TYPES = ["A", "C", "F", "JR", "N", "P", "SS", "TV", "VG", "YR"]
+
+
+def make_rows(count):
+    rng = random.Random(count)
+    return [
+        {
+            "title": " ".join(rng.choices(WORDS, k=3)) + f" {i}",
+            "episode_title": " ".join(rng.choices(WORDS, k=2)) if i % 2 else None,
+            "content_type": TYPES[i % len(TYPES)],
+            "natural_key": str(i),
+            "watched": False,
+        }
+        for i in range(count)
+    ]
+
+
+def like_query(q):
+    # The scan a search box would need without the FTS index
+    stmt = select(CanonMediaEntry)
+    for term in q.split():
+        pattern = f"%{term}%"
+        stmt = stmt.where(
+            CanonMediaEntry.title.like(pattern)
+            | CanonMediaEntry.episode_title.like(pattern)
+            | CanonMediaEntry.content_type.like(pattern)
+        )
+    return stmt.order_by(CanonMediaEntry.id)
+
+
+def measure(conn, stmt, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        matches = len(conn.execute(stmt).all())
+    return (time.perf_counter() - started) / repeat, matches
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark FTS5 search vs LIKE")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--limit", type=int, default=50, help="Rows per page")
+    args = parser.parse_args()
+    print(f"{'rows':>8} {'query':>12} {'method':>6} {'time (ms)':>10} {'matches':>8}")
+    for count in args.sizes:
+        engine = create_engine("sqlite://")
+        Base.metadata.create_all(engine)
+        with engine.begin() as conn:
+            conn.execute(insert(CanonMediaEntry), make_rows(count))
+        with engine.connect() as conn:
+            for q in SEARCHES:
+                for name, stmt in (
+                    ("like", like_query(q).limit(args.limit)),
+                    (
+                        "fts",
+                        media_query(MediaFilter(q=q, order="rank", limit=args.limit)),
+                    ),
+                ):
+                    elapsed, matches = measure(conn, stmt, args.repeat)
+                    print(
+                        f"{count:>8} {q:>12} {name:>6} {elapsed * 1000:>10.1f} {matches:>8}"
+                    )
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+
+from benchmarks.bench_media_table import make_rows
+from models import CanonMediaEntrySchema
+from snapshot import read_snapshot, write_snapshot
+
+SIZES = [10_000, 100_000]
+
+
+def write_json(path, rows):
+    # The canon_media.json layout: one pretty-printed array of entries
+    with open(path, "w") as f:
+        json.dump([row.model_dump() for row in rows], f, indent=2)
+    return os.path.getsize(path)
+
+
+def read_json(path):
+    with open(path) as f:
+        return [CanonMediaEntrySchema.model_validate(m) for m in json.load(f)]
+
+
+def write_plain(path, rows):
+    return write_snapshot(path, rows)
+
+
+def write_zlib(path, rows):
+    return write_snapshot(path, rows, compress=True)
+
+
+FORMATS = [
+    ("json", write_json, read_json),
+    ("snapshot", write_plain, read_snapshot),
+    ("snapshot+zlib", write_zlib, read_snapshot),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark catalogue snapshots")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    args = parser.parse_args()
+    print(
+        f"{'rows':>8} {'format':>14} {'write (ms)':>11} {'read (ms)':>10} "
+        f"{'bytes':>12} {'round-trip':>10}"
+    )
+    with tempfile.TemporaryDirectory() as directory:
+        for count in args.sizes:
+            rows = make_rows(count)
+            for name, write, read in FORMATS:
+                path = os.path.join(directory, name)
+                started = time.perf_counter()
+                size = write(path, rows)
+                written = time.perf_counter() - started
+                started = time.perf_counter()
+                loaded = read(path)
+                elapsed = time.perf_counter() - started
+                same = [m.model_dump() for m in loaded] == [
+                    m.model_dump() for m in rows
+                ]
+                print(
+                    f"{count:>8} {name:>14} {written * 1000:>11.1f} "
+                    f"{elapsed * 1000:>10.1f} {size:>12} {'ok' if same else 'FAILED':>10}"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import time
+
+
+def percentile(samples, pct):
+    if len(samples) < 2:
+        return samples[0] if samples else 0.0
+    return statistics.quantiles(samples, n=100, method="inclusive")[pct - 1]
+
+
+async def run(client, args, max_id):
+    latencies = {"read": [], "write": []}
+    errors = 0
+    deadline = time.perf_counter() + args.duration
+
+    async def user():
+        nonlocal errors
+        while time.perf_counter() < deadline:
+            if random.random() < args.write_ratio:
+                kind = "write"
+                request = client.post(
+                    f"/media/{random.randint(1, max_id)}/watched",
+                    data={"watched": random.choice(["true", "false"])},
+                )
+            else:
+                kind = "read"
+                request = client.get(
+                    "/media",
+                    params={"limit": 50, "after": random.randint(0, max_id)},
+                )
+            started = time.perf_counter()
+            response = await request
+            latencies[kind].append((time.perf_counter() - started) * 1000)
+            if response.status_code >= 400:
+                errors += 1
+
+    await asyncio.gather(*(user() for _ in range(args.clients)))
+    return latencies, errors
+
+
+async def main(args):
+    import httpx
+
+    if args.url:
+        client = httpx.AsyncClient(base_url=args.url, timeout=60)
+        lifespan = None
+    else:
+        # In-process: drive the ASGI app directly against SQLITE_PATH
+        from main import app
+
+        client = httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=app), base_url="http://bench", timeout=60
+        )
+        lifespan = app.router.lifespan_context(app)
+        await lifespan.__aenter__()
+    try:
+        async with client:
+            listing = await client.get("/media", params={"stream": "true"})
+            max_id = json.loads(listing.text.splitlines()[-1])["id"]
+            latencies, errors = await run(client, args, max_id)
+    finally:
+        if lifespan is not None:
+            await lifespan.__aexit__(None, None, None)
+    print(
+        f"{args.clients} clients, {args.duration}s, "
+        f"{args.write_ratio:.0%} writes, {errors} errors"
+    )
+    print(f"{'kind':>6} {'count':>7} {'p50 (ms)':>9} {'p99 (ms)':>9} {'max (ms)':>9}")
+    for kind, samples in latencies.items():
+        if samples:
+            print(
+                f"{kind:>6} {len(samples):>7} {percentile(samples, 50):>9.2f} "
+                f"{percentile(samples, 99):>9.2f} {max(samples):>9.2f}"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Measure read/write latency under mixed /media traffic"
+    )
+    parser.add_argument("--url", help="Target a running server instead of in-process")
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--write-ratio", type=float, default=0.2)
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Serve in-process reads from SQLite rather than the catalogue cache",
+    )
+    args = parser.parse_args()
+    if args.no_cache:
+        os.environ["CATALOGUE_CACHE"] = "0"
+    asyncio.run(main(args))
@@ -0,0 +1,370 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from datetime import datetime, timezone
+
+from benchmarks.load_test import percentile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SIZES = [1_000, 10_000, 100_000]
+RESULTS_DIR = "bench-results"
+# The importer and scraper don't need the biggest catalogues to show a trend
+IMPORT_MAX_ROWS = 100_000
+SCRAPER_ROWS = 2_000
+
+
+def summarize(samples):
+    ms = [s * 1000 for s in samples]
+    return {
+        "n": len(ms),
+        "mean_ms": round(sum(ms) / len(ms), 3),
+        "p50_ms": round(percentile(ms, 50), 3),
+        "p95_ms": round(percentile(ms, 95), 3),
+        "max_ms": round(max(ms), 3),
+    }
+
+
+async def measure(send, count):
+    samples = []
+    for _ in range(count):
+        started = time.perf_counter()
+        response = await send()
+        samples.append(time.perf_counter() - started)
+        # The form endpoints answer with a 303 back to the table
+        if response.is_error:
+            response.raise_for_status()
+    return summarize(samples)
+
+
+@contextlib.contextmanager
+def timed(results, name):
+    # Progress output from the importer and scraper is dropped
+    started = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        yield
+    results[name] = summarize([time.perf_counter() - started])
+
+
+async def bench_app(args):
+    # Each worker runs in its own process, so the engine binds to this run's
+    # SQLITE_PATH when db is first imported
+    import httpx
+
+    from benchmarks.synthetic import populate
+    from db import engine
+
+    results = {}
+    with timed(results, "populate"):
+        await populate(engine, args.rows, args.seed)
+    from main import app
+
+    rng = random.Random(args.seed)
+    lifespan = app.router.lifespan_context(app)
+    with timed(results, "startup"):
+        await lifespan.__aenter__()
+    transport = httpx.ASGITransport(app=app)
+    # Uncompressed, so the table timings don't depend on the gzip cache
+    headers = {"Accept-Encoding": "identity"}
+    try:
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://bench", headers=headers, timeout=600
+        ) as client:
+            light, heavy = args.requests, args.full_requests
+            cases = {
+                "media_page": (
+                    lambda: client.get(
+                        "/media",
+                        params={"limit": 50, "after": rng.randint(0, args.rows)},
+                    ),
+                    light,
+                ),
+                "media_filtered": (
+                    lambda: client.get(
+                        "/media",
+                        params={"content_type": "TV", "watched": "false", "limit": 500},
+                    ),
+                    light,
+                ),
+                "media_year": (
+                    lambda: client.get("/media", params={"order": "year", "limit": 50}),
+                    light,
+                ),
+                "media_search": (
+                    lambda: client.get("/media", params={"q": "jedi", "limit": 50}),
+                    light,
+                ),
+                "media_full": (lambda: client.get("/media"), heavy),
+                "media_stream": (
+                    lambda: client.get("/media", params={"stream": "true"}),
+                    heavy,
+                ),
+                "media_table": (lambda: client.get("/media/table"), heavy),
+                "media_table_plain": (
+                    lambda: client.get("/media/table", params={"plain": "true"}),
+                    heavy,
+                ),
+                "media_table_tv": (
+                    lambda: client.get("/media/table", params={"content_type": "TV"}),
+                    heavy,
+                ),
+                "update_watched": (
+                    lambda: client.post(
+                        f"/media/{rng.randint(1, args.rows)}/watched",
+                        data={"watched": rng.choice(["true", "false"])},
+                    ),
+                    light,
+                ),
+                "update_watched_bulk": (
+                    lambda: client.post(
+                        "/media/watched",
+                        json={
+                            "watched": rng.choice([True, False]),
+                            "content_type": ["F"],
+                        },
+                    ),
+                    light,
+                ),
+            }
+            for name, (send, count) in cases.items():
+                if name in args.skip:
+                    continue
+                results[name] = await measure(send, count)
+    finally:
+        await lifespan.__aexit__(None, None, None)
+    return results
+
+
+async def bench_import(args):
+    from benchmarks.synthetic import write_html
+    from scrape_canon_media import scrape_and_store
+
+    path = os.path.abspath("media_table.html")
+    write_html(path, args.rows, args.seed)
+    results = {}
+    with timed(results, "import_initial"):
+        await scrape_and_store(path, args.parser)
+    with timed(results, "import_unchanged"):
+        await scrape_and_store(path, args.parser)
+    # The same page after an upstream edit: mostly unchanged rows, a few
+    # updated in place, a few removed and a few added
+    write_html(path, args.rows, args.seed, revised=True)
+    with timed(results, "import_changed"):
+        await scrape_and_store(path, args.parser, soft_delete=True)
+    return results
+
+
+def episode_page(name: str) -> str:
+    number = zlib.crc32(name.encode())
+    return (
+        f"<html><body><h1>{name}</h1><aside class='portable-infobox'>"
+        f"<div data-source='season' class='pi-item'>"
+        f"<div class='pi-data-value'><a>{number % 7 + 1}</a></div></div>"
+        f"<div data-source='episode' class='pi-item'>"
+        f"<div class='pi-data-value'>{number % 22 + 1}</div></div>"
+        f"</aside>{'<p>Lorem ipsum dolor sit amet.</p>' * 200}</body></html>"
+    )
+
+
+async def mock_wiki():
+    # Stand-in for the wiki: one page per path, with an ETag so the second
+    # pass revalidates with 304s
+    from aiohttp import web
+
+    async def page(request):
+        name = request.match_info["name"]
+        etag = f'"{zlib.crc32(name.encode()):x}"'
+        if request.headers.get("If-None-Match") == etag:
+            return web.Response(status=304, headers={"ETag": etag})
+        return web.Response(
+            text=episode_page(name), content_type="text/html", headers={"ETag": etag}
+        )
+
+    app = web.Application()
+    app.router.add_get("/wiki/{name}", page)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    return runner, f"http://127.0.0.1:{port}"
+
+
+async def bench_scraper(args):
+    from benchmarks.synthetic import populate
+    from db import engine
+    from scrape_episode_urls import scrape_episode_urls
+
+    await populate(engine, args.rows, args.seed)
+    runner, base_url = await mock_wiki()
+    results = {}
+    # The rate limiter is opened up so the timings measure the scraper itself
+    options = dict(
+        concurrency=args.concurrency, rate=1e9, burst=10**9, base_url=base_url
+    )
+    try:
+        with timed(results, "scrape_cold"):
+            await scrape_episode_urls(**options)
+        with timed(results, "scrape_revalidate"):
+            await scrape_episode_urls(**options)
+    finally:
+        await runner.cleanup()
+    return results
+
+
+WORKERS = {"app": bench_app, "import": bench_import, "scraper": bench_scraper}
+
+
+def run_worker(task, rows, args):
+    # A fresh process and directory per run: a new database, page cache and
+    # import-time configuration every time
+    with tempfile.TemporaryDirectory() as directory:
+        output = os.path.join(directory, "result.json")
+        env = dict(
+            os.environ,
+            SQLITE_PATH=os.path.join(directory, "bench.db"),
+            PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.getenv("PYTHONPATH")])),
+        )
+        command = [
+            sys.executable,
+            "-m",
+            "benchmarks.suite",
+            "--worker",
+            task,
+            "--rows",
+            str(rows),
+            "--output",
+            output,
+            "--seed",
+            str(args.seed),
+            "--requests",
+            str(args.requests),
+            "--full-requests",
+            str(args.full_requests),
+            "--parser",
+            args.parser,
+            "--concurrency",
+            str(args.concurrency),
+            "--skip",
+            *args.skip,
+        ]
+        subprocess.run(command, cwd=directory, env=env, check=True)
+        with open(output) as f:
+            return json.load(f)
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def print_results(results, baseline=None):
+    print(
+        f"{'task':>8} {'rows':>8} {'metric':>20} {'p50 (ms)':>11} {'p95 (ms)':>11}",
+        end="",
+    )
+    print(f" {'base p50':>11} {'change':>8}" if baseline else "")
+    for task, sizes in results.items():
+        for rows, metrics in sizes.items():
+            for name, stats in metrics.items():
+                line = (
+                    f"{task:>8} {rows:>8} {name:>20} "
+                    f"{stats['p50_ms']:>11.2f} {stats['p95_ms']:>11.2f}"
+                )
+                if baseline:
+                    before = baseline.get(task, {}).get(rows, {}).get(name)
+                    if before:
+                        change = stats["p50_ms"] / before["p50_ms"] - 1
+                        line += f" {before['p50_ms']:>11.2f} {change:>+8.1%}"
+                print(line)
+
+
+def main(args):
+    commit = git_commit()
+    results = {}
+    for task in ("app", "import", "scraper"):
+        if task in args.skip:
+            continue
+        if task == "scraper":
+            sizes = [args.scraper_rows]
+        elif task == "import":
+            sizes = [n for n in args.sizes if n <= args.import_max_rows]
+        else:
+            sizes = args.sizes
+        for rows in sizes:
+            print(f"Running {task} with {rows} rows...", file=sys.stderr)
+            results.setdefault(task, {})[str(rows)] = run_worker(task, rows, args)
+    report = {
+        "commit": commit,
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+    output = args.output or os.path.join(RESULTS_DIR, f"{commit}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            compared = json.load(f)
+        baseline = compared["results"]
+        print(f"Compared against {compared['commit']} ({compared['created']})")
+    print_results(results, baseline)
+    print(f"Wrote {output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the API, importer and scraper on synthetic catalogues"
+    )
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    parser.add_argument("--output", help=f"Defaults to {RESULTS_DIR}/<commit>.json")
+    parser.add_argument("--compare", help="Print p50 changes against this result file")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--requests", type=int, default=200, help="Samples per small request"
+    )
+    parser.add_argument(
+        "--full-requests",
+        type=int,
+        default=5,
+        help="Samples per full-catalogue request",
+    )
+    parser.add_argument("--import-max-rows", type=int, default=IMPORT_MAX_ROWS)
+    parser.add_argument("--scraper-rows", type=int, default=SCRAPER_ROWS)
+    # The importer's own default
+    parser.add_argument("--parser", choices=["bs4", "lxml"], default="bs4")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument(
+        "--skip",
+        nargs="*",
+        default=[],
+        help="Tasks (app, import, scraper) or app metrics to leave out",
+    )
+    parser.add_argument("--worker", choices=sorted(WORKERS), help=argparse.SUPPRESS)
+    parser.add_argument("--rows", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker:
+        worker_results = asyncio.run(WORKERS[args.worker](args))
+        with open(args.output, "w") as f:
+            json.dump(worker_results, f)
+    else:
+        main(args)
@@ -0,0 +1,194 @@
+import argparse
+import asyncio
+import random
+from typing import Iterator, List
+
+from chronology import year_sort_keys
+from media_parsers import WIKI_ORIGIN, ParsedRow
+
+# Share of each content type in the real catalogue (media_table.html)
+CONTENT_TYPES = {
+    "C": 1275,
+    "TV": 681,
+    "SS": 212,
+    "YR": 181,
+    "JR": 98,
+    "N": 78,
+    "VG": 43,
+    "P": 26,
+    "F": 18,
+    "A": 14,
+}
+# Most shows run one or two seasons; a few run to seven
+SEASONS = {"S01": 40, "S02": 25, "S03": 14, "S04": 9, "S05": 6, "S06": 4, "S07": 2}
+EPISODES_PER_SEASON = 22
+SHOWS = [
+    "The Clone Wars",
+    "Rebels",
+    "Resistance",
+    "The Bad Batch",
+    "Andor",
+    "The Mandalorian",
+    "Young Jedi Adventures",
+    "Tales of the Jedi",
+]
+# Share of rows retargeted, and of rows dropped and added, by revise_rows
+REVISED_SHARE = 0.03
+WORDS = "Shadow Jedi Empire Rebel Star Fall Rise Hunt Legacy Order Dawn Storm".split()
+INSERT_BATCH_SIZE = 5000
+
+
+def _year(rng: random.Random) -> str:
+    # Heavily clustered around the films, with a long tail back to the
+    # High Republic and beyond
+    if rng.random() < 0.1:
+        return f"{rng.randint(100, 25000)} BBY"
+    if rng.random() < 0.5:
+        return f"{rng.randint(0, 40)} BBY"
+    return f"{rng.randint(0, 40)} ABY"
+
+
+def _link(path: str, text: str, origin: str = WIKI_ORIGIN) -> str:
+    return f'<a href="{origin}/wiki/{path}" title="{text}">{text}</a>'
+
+
+def generate_rows(count: int, seed: int = 0) -> Iterator[ParsedRow]:
+    # Rows in the importer's shape, in chronological order like the wiki
+    rng = random.Random(seed)
+    types = rng.choices(list(CONTENT_TYPES), list(CONTENT_TYPES.values()), k=count)
+    years = sorted(
+        (_year(rng) for _ in range(count)),
+        key=lambda y: -int(y.split()[0]) if y.endswith("BBY") else int(y.split()[0]),
+    )
+    for i, (year, content_type) in enumerate(zip(years, types)):
+        released = f"{rng.randint(1977, 2025)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}"
+        if content_type == "TV":
+            show = f"Star Wars: {rng.choice(SHOWS)}"
+            episode = f"{' '.join(rng.choices(WORDS, k=2))} {i}"
+            title_html = (
+                f"<i>{_link(show.replace(' ', '_'), show)}</i> — "
+                f'"{_link(episode.replace(" ", "_"), episode)}"'
+            )
+            episode_url = f"{WIKI_ORIGIN}/wiki/{episode.replace(' ', '_')}"
+            title, episode_title = show, episode
+        else:
+            title = f"{' '.join(rng.choices(WORDS, k=3))} {i}"
+            title_html = f"<i>{_link(title.replace(' ', '_'), title)}</i>"
+            episode_url = f"{WIKI_ORIGIN}/wiki/{title.replace(' ', '_')}"
+            episode_title = None
+        yield ParsedRow(
+            year=year,
+            year_html=_link(year.replace(" ", "_"), year),
+            content_type=content_type,
+            content_type_html=content_type,
+            title=title,
+            title_html=title_html,
+            episode_title=episode_title,
+            episode_url=episode_url,
+            released=released,
+            released_html=released,
+        )
+
+
+def revise_rows(
+    rows: List[ParsedRow], seed: int = 0, share: float = REVISED_SHARE
+) -> List[ParsedRow]:
+    # The next upstream edit of the same page: a few title links retargeted
+    # (same natural key, new content hash), a few rows dropped and as many new
+    # ones added next to existing rows
+    rng = random.Random(seed + 2)
+    added = generate_rows(len(rows), seed + 1)
+    revised = []
+    for row in rows:
+        roll = rng.random()
+        if roll < share:
+            row = row._replace(
+                title_html=row.title_html.replace("/wiki/", "/wiki/Legends:")
+            )
+        elif roll < 2 * share:
+            continue
+        elif roll < 3 * share:
+            new = next(added)
+            revised.append(new._replace(year=row.year, year_html=row.year_html))
+        revised.append(row)
+    return revised
+
+
+def write_html(path: str, count: int, seed: int = 0, revised: bool = False) -> int:
+    # A media_table.html lookalike for the importer, with site-relative hrefs
+    # as on the wiki
+    rows = list(generate_rows(count, seed))
+    if revised:
+        rows = revise_rows(rows, seed)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(
+            "<table><tr><th>Year</th><th></th><th>Title</th>" "<th>Released</th></tr>\n"
+        )
+        for row in rows:
+            cells = (row.year_html, row.content_type_html, row.title_html, row.released)
+            f.write(
+                "<tr>"
+                + "".join(f"<td>{c.replace(WIKI_ORIGIN, '')}</td>" for c in cells)
+                + "</tr>\n"
+            )
+    return len(rows)
+
+
+def database_rows(count: int, seed: int = 0) -> List[dict]:
+    from fragments import normalize_row
+    from models import make_content_hash
+
+    rng = random.Random(seed + 1)
+    rows = list(generate_rows(count, seed))
+    values = []
+    for row, year_sort in zip(rows, year_sort_keys(row.year for row in rows)):
+        entry = normalize_row({**row._asdict(), "year_sort": year_sort})
+        entry["content_hash"] = make_content_hash(entry)
+        entry["natural_key"] = row.natural_key
+        entry["watched"] = rng.random() < 0.3
+        if row.content_type == "TV":
+            entry["season"] = rng.choices(list(SEASONS), list(SEASONS.values()))[0]
+            entry["episode"] = f"E{rng.randint(1, EPISODES_PER_SEASON):02d}"
+        else:
+            entry["season"] = entry["episode"] = ""
+        values.append(entry)
+    return values
+
+
+async def populate(engine, count: int, seed: int = 0) -> int:
+    # Fills an empty database through the app's own schema (and triggers)
+    from sqlalchemy import insert
+
+    from fragments import intern_fragments
+    from migrations import migrate
+    from models import CanonMediaEntry
+
+    await migrate(engine)
+    values = database_rows(count, seed)
+    async with engine.begin() as conn:
+        for start in range(0, len(values), INSERT_BATCH_SIZE):
+            batch = values[start : start + INSERT_BATCH_SIZE]
+            await conn.run_sync(intern_fragments, batch)
+            await conn.execute(insert(CanonMediaEntry), batch)
+    return len(values)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic catalogue")
+    parser.add_argument("rows", type=int)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--html", help="Write a media_table.html lookalike here")
+    args = parser.parse_args()
+    if args.html:
+        write_html(args.html, args.rows, args.seed)
+        print(f"Wrote {args.rows} rows to {args.html}")
+        return
+    # Into the database named by SQLITE_PATH
+    from db import engine
+
+    written = asyncio.run(populate(engine, args.rows, args.seed))
+    print(f"Inserted {written} rows")
+
+
+if __name__ == "__main__":
+    main()
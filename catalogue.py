@@ -0,0 +1,231 @@
+import asyncio
+import heapq
+import os
+from bisect import bisect_left, bisect_right
+from itertools import islice
+from typing import AsyncIterator, Dict, Iterator, List, Tuple
+
+from sqlalchemy import select
+
+from db import AsyncSessionLocal
+from fragments import (
+    Cell,
+    cell_refs,
+    join_cell,
+    load_fragments,
+    normalize_html,
+    resolve_cell,
+    split_html,
+)
+from metrics import span
+from models import (
+    HTML_COLUMNS,
+    CanonMediaEntry,
+    CanonMediaEntrySchema,
+    MediaFilter,
+    WatchState,
+    data_version,
+)
+
+CATALOGUE_CACHE = os.getenv("CATALOGUE_CACHE", "1") != "0"
+
+
+async def fetch_data_version(session):
+    return (await session.execute(select(data_version))).one()
+
+
+class Catalogue:
+    # In-memory copy of canon_media. The static columns only change when the
+    # importer or a scraper runs, so each row is validated once at load time
+    # and reloaded when data_version says so; the watched flag lives in a
+    # separate bytearray indexed by id and is written through by
+    # update_watched. The *_html cells are kept as tuples of shared fragment
+    # strings and only joined for rows that are actually served.
+
+    def __init__(self):
+        self.loaded = False
+        self._rows: Dict[int, CanonMediaEntrySchema] = {}
+        self._cells: Dict[int, Tuple[Cell, ...]] = {}
+        self._ids: List[int] = []
+        self._ids_by_type: Dict[str, List[int]] = {}
+        self._watched = bytearray()
+        self.content_types: List[str] = []
+        # (media_version, watched_version) from data_version as of the last
+        # load, moved along by our own watched updates
+        self._synced = (0, 0)
+        self._reload_lock = asyncio.Lock()
+
+    async def sync(self):
+        # Called before every read. Returns the current data_version row and,
+        # when another process has changed canon_media since the last load,
+        # reloads the rows or just the watched flags first.
+        async with AsyncSessionLocal() as session:
+            state = await fetch_data_version(session)
+        if not self.loaded:
+            return state
+        if (state.media_version, state.watched_version) != self._synced:
+            async with self._reload_lock:
+                if self._synced[0] < state.media_version:
+                    await self.load()
+                elif self._synced[1] < state.watched_version:
+                    await self.load_watched()
+        return state
+
+    async def load(self, entries: List[CanonMediaEntrySchema] = None):
+        # entries, when given, must be the table's full contents in id order.
+        # The counters are read first, so rows written meanwhile only cause
+        # another reload later.
+        cells = {}
+        async with AsyncSessionLocal() as session:
+            state = await fetch_data_version(session)
+        if entries is None:
+            async with AsyncSessionLocal() as session:
+                fragments = await session.run_sync(load_fragments)
+                result = await session.execute(
+                    select(CanonMediaEntry).order_by(CanonMediaEntry.id)
+                )
+                entries = []
+                for m in result.scalars():
+                    entries.append(CanonMediaEntrySchema.model_validate(m))
+                    cells[m.id] = tuple(
+                        resolve_cell(fragments, refs) for refs in cell_refs(m)
+                    )
+        else:
+            shared: Dict[str, str] = {}
+            for m in entries:
+                cells[m.id] = tuple(
+                    _split_cell(getattr(m, name), shared) for name in HTML_COLUMNS
+                )
+            entries = [
+                m.model_copy(update=dict.fromkeys(HTML_COLUMNS)) for m in entries
+            ]
+        rows = {}
+        ids_by_type: Dict[str, List[int]] = {}
+        watched = bytearray(entries[-1].id + 1 if entries else 0)
+        for m in entries:
+            rows[m.id] = m
+            ids_by_type.setdefault(m.content_type, []).append(m.id)
+            watched[m.id] = m.watched
+        # Swap everything in at once so readers never see a half-built cache
+        self._rows = rows
+        self._cells = cells
+        self._ids = [m.id for m in entries]
+        self._ids_by_type = ids_by_type
+        self._watched = watched
+        self.content_types = sorted(t for t in ids_by_type if t)
+        self._synced = (state.media_version, state.watched_version)
+        self.loaded = True
+
+    async def load_watched(self):
+        async with AsyncSessionLocal() as session:
+            state = await fetch_data_version(session)
+            result = await session.execute(
+                select(CanonMediaEntry.id, CanonMediaEntry.watched)
+            )
+            watched = bytearray(len(self._watched))
+            for media_id, is_watched in result:
+                # Rows added since the last load wait for the reload it needs
+                if media_id in self._rows:
+                    watched[media_id] = bool(is_watched)
+        self._watched = watched
+        self._synced = (self._synced[0], state.watched_version)
+
+    def supports(self, filters: MediaFilter) -> bool:
+        # Chronological order and search are served by SQLite's indexes
+        return self.loaded and filters.order == "id" and not filters.q
+
+    def set_watched(self, media_ids: List[int], watched: bool, state):
+        # Writes through an update of media_ids committed with the
+        # data_version row state read in the same transaction. When nobody
+        # else wrote since the last sync the flags are now current; otherwise
+        # the next sync reloads them.
+        for media_id in media_ids:
+            if media_id in self._rows:
+                self._watched[media_id] = watched
+        if self._synced == (
+            state.media_version,
+            state.watched_version - len(media_ids),
+        ):
+            self._synced = (state.media_version, state.watched_version)
+
+    def _id_range(self, ids: List[int], filters: MediaFilter) -> Iterator[int]:
+        start = 0 if filters.id_gt is None else bisect_right(ids, filters.id_gt)
+        stop = len(ids) if filters.id_lt is None else bisect_left(ids, filters.id_lt)
+        return (ids[i] for i in range(start, stop))
+
+    async def watched_flags(self, filters: MediaFilter) -> bytearray:
+        # Shared rows are reused for every user; only the user's watched ids
+        # are read, straight off watch_state's primary key.
+        if filters.user_id is None:
+            return self._watched
+        async with AsyncSessionLocal() as session:
+            result = await session.execute(
+                select(WatchState.media_id).where(WatchState.user_id == filters.user_id)
+            )
+            flags = bytearray(len(self._watched))
+            for media_id in result.scalars():
+                if media_id < len(flags):
+                    flags[media_id] = 1
+        return flags
+
+    def iter_rows(
+        self, filters: MediaFilter, watched: bytearray = None
+    ) -> Iterator[CanonMediaEntrySchema]:
+        if filters.content_type:
+            ranges = [
+                self._id_range(self._ids_by_type[t], filters)
+                for t in set(filters.content_type)
+                if t in self._ids_by_type
+            ]
+            ids = heapq.merge(*ranges)
+        else:
+            ids = self._id_range(self._ids, filters)
+        if watched is None:
+            watched = self._watched
+        rows = self._rows
+        cells = self._cells if filters.include_html else None
+        year_from, year_to = filters.year_from, filters.year_to
+        for media_id in ids:
+            is_watched = bool(watched[media_id])
+            if filters.watched is not None and is_watched != filters.watched:
+                continue
+            row = rows[media_id]
+            if year_from is not None or year_to is not None:
+                if row.year_sort is None:
+                    continue
+                if year_from is not None and row.year_sort < year_from:
+                    continue
+                if year_to is not None and row.year_sort > year_to:
+                    continue
+            update = {"watched": is_watched}
+            if cells is not None:
+                update.update(zip(HTML_COLUMNS, map(join_cell, cells[media_id])))
+            yield row.model_copy(update=update)
+
+    async def select(self, filters: MediaFilter) -> List[CanonMediaEntrySchema]:
+        watched = await self.watched_flags(filters)
+        with span("filter"):
+            return list(islice(self.iter_rows(filters, watched), filters.limit))
+
+    async def iter_batches(
+        self, filters: MediaFilter, batch_size: int
+    ) -> AsyncIterator[List[CanonMediaEntrySchema]]:
+        watched = await self.watched_flags(filters)
+        rows = islice(self.iter_rows(filters, watched), filters.limit)
+        while True:
+            with span("filter"):
+                batch = list(islice(rows, batch_size))
+            if not batch:
+                return
+            yield batch
+
+
+def _split_cell(value, shared: Dict[str, str]) -> Cell:
+    if value is None:
+        return None
+    return tuple(
+        shared.setdefault(piece, piece) for piece in split_html(normalize_html(value))
+    )
+
+
+catalogue = Catalogue()
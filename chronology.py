@@ -0,0 +1,41 @@
+import re
+from typing import Iterable, Iterator, Optional
+
+FOOTNOTE_RE = re.compile(r"\[[^\]]*\]")
+YEAR_RE = re.compile(r"(-?\d[\d,]*)")
+ERA_RE = re.compile(r"(BBY|ABY)")
+
+
+def parse_year(year_str):
+    # Turns strings like "c. 232 BBY", "Long before 30,000BBY[1]" or
+    # "32 BBY–4 ABY" into a signed year (BBY negative, ABY positive). Ranges
+    # sort by their start; qualifiers such as "c.", "By" or "Long before" and
+    # footnote markers are ignored. A start year without an era of its own
+    # takes the next one mentioned ("14–4 BBY" is 14 BBY).
+    if not year_str:
+        return None
+    text = FOOTNOTE_RE.sub("", year_str)
+    match = YEAR_RE.search(text)
+    if not match:
+        return None
+    value = int(match.group(1).replace(",", ""))
+    era = ERA_RE.search(text, match.end())
+    if era is None:
+        return value
+    # BBY is negative, ABY is positive
+    if era.group(1) == "BBY":
+        return -abs(value)
+    return abs(value)
+
+
+def year_sort_keys(years: Iterable[Optional[str]]) -> Iterator[Optional[int]]:
+    # Keys for rows in timeline order. Rows without a parseable year sit
+    # between their neighbours in the canon list, so they inherit the
+    # previous row's key.
+    previous = None
+    for year in years:
+        key = parse_year(year)
+        if key is None:
+            key = previous
+        previous = key
+        yield key
@@ -1,12 +1,81 @@
+import asyncio
 import os
+from typing import List, NamedTuple
 
+from sqlalchemy import event
 from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from metrics import instrument_engine
 
 SQLITE_PATH = os.getenv("SQLITE_PATH", "canon_media.db")
 DATABASE_URL = f"sqlite+aiosqlite:///{SQLITE_PATH}"
 
-engine = create_async_engine(DATABASE_URL, echo=True)
+
+class EngineProfile(NamedTuple):
+    echo: bool = False
+    journal_mode: str = "WAL"
+    synchronous: str = "NORMAL"
+    busy_timeout_ms: int = 5000
+    cache_size_kib: int = 64 * 1024
+    mmap_size: int = 256 * 1024 * 1024
+    pool_size: int = 5
+    max_overflow: int = 10
+
+    @classmethod
+    def from_env(cls) -> "EngineProfile":
+        default = cls()
+        return cls(
+            echo=os.getenv("SQL_ECHO", "0") == "1",
+            journal_mode=os.getenv("SQLITE_JOURNAL_MODE", default.journal_mode),
+            synchronous=os.getenv("SQLITE_SYNCHRONOUS", default.synchronous),
+            busy_timeout_ms=int(
+                os.getenv("SQLITE_BUSY_TIMEOUT_MS", default.busy_timeout_ms)
+            ),
+            cache_size_kib=int(
+                os.getenv("SQLITE_CACHE_SIZE_KIB", default.cache_size_kib)
+            ),
+            mmap_size=int(os.getenv("SQLITE_MMAP_SIZE", default.mmap_size)),
+            pool_size=int(os.getenv("SQLITE_POOL_SIZE", default.pool_size)),
+            max_overflow=int(os.getenv("SQLITE_MAX_OVERFLOW", default.max_overflow)),
+        )
+
+    def pragmas(self) -> List[str]:
+        return [
+            f"PRAGMA journal_mode = {self.journal_mode}",
+            f"PRAGMA synchronous = {self.synchronous}",
+            f"PRAGMA busy_timeout = {self.busy_timeout_ms}",
+            # Negative cache_size is in KiB rather than pages
+            f"PRAGMA cache_size = -{self.cache_size_kib}",
+            f"PRAGMA mmap_size = {self.mmap_size}",
+            # foreign_keys stays off on purpose; see models.WatchState
+        ]
+
+
+def make_engine(url: str = DATABASE_URL, profile: EngineProfile = None):
+    profile = profile or EngineProfile.from_env()
+    new_engine = create_async_engine(
+        url,
+        echo=profile.echo,
+        poolclass=AsyncAdaptedQueuePool,
+        pool_size=profile.pool_size,
+        max_overflow=profile.max_overflow,
+    )
+
+    @event.listens_for(new_engine.sync_engine, "connect")
+    def apply_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in profile.pragmas():
+            cursor.execute(pragma)
+        cursor.close()
+
+    return new_engine
+
+
+engine = make_engine()
+instrument_engine(engine)
 AsyncSessionLocal = async_sessionmaker(engine, expire_on_commit=False)
+write_lock = asyncio.Lock()
 
 
 def get_session():
@@ -0,0 +1,198 @@
+import hashlib
+import os
+import re
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.dialects.sqlite import insert
+
+from models import (
+    HTML_COLUMNS,
+    CanonMediaEntry,
+    HtmlFragment,
+    RemovedMediaEntry,
+    refs_column,
+)
+
+# Cells are split into citation superscripts, links and the text between
+# them. Years, types and release dates repeat the same links across many rows
+# and shows repeat their series link on every episode, so most pieces are
+# shared. Links never nest, and a citation's own link stays inside it.
+FRAGMENT_RE = re.compile(r'(<sup class="reference".*?</sup>|<a\s[^>]*>.*?</a>)', re.S)
+WHITESPACE_RE = re.compile(r"\s+")
+FRAGMENT_CACHE_SIZE = int(os.getenv("FRAGMENT_CACHE_SIZE", "20000"))
+# Values per IN (...) lookup, well under SQLite's variable limit
+LOOKUP_BATCH_SIZE = 500
+
+Cell = Optional[Tuple[str, ...]]
+
+
+def normalize_html(value: Optional[str]) -> Optional[str]:
+    # The wiki's source indentation renders as a single space anyway
+    if value is None:
+        return None
+    return WHITESPACE_RE.sub(" ", value).strip()
+
+
+def normalize_row(values: dict) -> dict:
+    for name in HTML_COLUMNS:
+        if name in values:
+            values[name] = normalize_html(values[name])
+    return values
+
+
+def split_html(value: str) -> List[str]:
+    return [piece for piece in FRAGMENT_RE.split(value) if piece]
+
+
+def fragment_digest(fragment: str) -> int:
+    digest = hashlib.blake2b(fragment.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little", signed=True)
+
+
+def encode_refs(ids: Iterable[int]) -> str:
+    return ",".join(map(str, ids))
+
+
+def decode_refs(refs: str) -> List[int]:
+    return [int(i) for i in refs.split(",")] if refs else []
+
+
+def batches(items: list, size: int = LOOKUP_BATCH_SIZE):
+    for start in range(0, len(items), size):
+        yield items[start : start + size]
+
+
+def _lookup(conn, digests: List[int]) -> Dict[int, Tuple[int, str]]:
+    table = HtmlFragment.__table__
+    found = {}
+    for batch in batches(digests):
+        result = conn.execute(
+            select(table.c.digest, table.c.id, table.c.html).where(
+                table.c.digest.in_(batch)
+            )
+        )
+        found.update((digest, (i, html)) for digest, i, html in result)
+    return found
+
+
+def intern_fragments(conn, rows: List[dict]):
+    # Replaces each row's *_html values with *_html_refs, adding any new
+    # fragments to html_fragments. Takes a sync connection; async callers go
+    # through run_sync. Values should already be normalized.
+    split = {}
+    for values in rows:
+        for name in HTML_COLUMNS:
+            value = values.pop(name, None)
+            values[refs_column(name)] = None if value is None else split_html(value)
+            if value:
+                split.update((p, None) for p in values[refs_column(name)])
+    digests = {fragment: fragment_digest(fragment) for fragment in split}
+    found = _lookup(conn, list(digests.values()))
+    missing = [
+        {"digest": digest, "html": fragment}
+        for fragment, digest in digests.items()
+        if digest not in found
+    ]
+    if missing:
+        stmt = insert(HtmlFragment.__table__).on_conflict_do_nothing()
+        for batch in batches(missing):
+            conn.execute(stmt, batch)
+        found.update(_lookup(conn, [m["digest"] for m in missing]))
+    ids = {}
+    for fragment, digest in digests.items():
+        fragment_id, html = found[digest]
+        if html != fragment:
+            raise ValueError(f"Fragment digest collision for {fragment!r}")
+        ids[fragment] = fragment_id
+    for values in rows:
+        for name in HTML_COLUMNS:
+            pieces = values[refs_column(name)]
+            if pieces is not None:
+                values[refs_column(name)] = encode_refs(ids[p] for p in pieces)
+
+
+def load_fragments(conn, ids: Optional[List[int]] = None) -> Dict[int, str]:
+    # All fragments when ids is None
+    table = HtmlFragment.__table__
+    stmt = select(table.c.id, table.c.html)
+    if ids is None:
+        return dict(conn.execute(stmt).all())
+    fragments = {}
+    for batch in batches(ids):
+        fragments.update(conn.execute(stmt.where(table.c.id.in_(batch))).all())
+    return fragments
+
+
+def prune_fragments(conn) -> int:
+    # Drops fragments no longer referenced by canon_media or its archive
+    used = set()
+    for model in (CanonMediaEntry, RemovedMediaEntry):
+        columns = [model.__table__.c[refs_column(n)] for n in HTML_COLUMNS]
+        for row in conn.execute(select(*columns)):
+            for refs in row:
+                used.update(decode_refs(refs))
+    table = HtmlFragment.__table__
+    stale = [i for i in conn.execute(select(table.c.id)).scalars() if i not in used]
+    for batch in batches(stale):
+        conn.execute(table.delete().where(table.c.id.in_(batch)))
+    return len(stale)
+
+
+def resolve_cell(fragments: Dict[int, str], refs: Optional[str]) -> Cell:
+    if refs is None:
+        return None
+    return tuple(fragments[i] for i in decode_refs(refs))
+
+
+def join_cell(cell: Cell) -> Optional[str]:
+    return None if cell is None else "".join(cell)
+
+
+def cell_refs(entry) -> Tuple[Optional[str], ...]:
+    return tuple(getattr(entry, refs_column(name)) for name in HTML_COLUMNS)
+
+
+class FragmentCache:
+    # LRU of recently rendered fragments for reads served straight from
+    # SQLite. Each batch of rows costs at most one lookup for the fragments
+    # it doesn't find here.
+
+    def __init__(self, max_size: int = FRAGMENT_CACHE_SIZE):
+        self.max_size = max_size
+        self._fragments: "OrderedDict[int, str]" = OrderedDict()
+
+    async def fetch(self, session, ids: Iterable[int]) -> Dict[int, str]:
+        found, missing = {}, []
+        for i in set(ids):
+            html = self._fragments.get(i)
+            if html is None:
+                missing.append(i)
+            else:
+                self._fragments.move_to_end(i)
+                found[i] = html
+        if missing:
+            loaded = await session.run_sync(load_fragments, missing)
+            found.update(loaded)
+            self._fragments.update(loaded)
+            while len(self._fragments) > self.max_size:
+                self._fragments.popitem(last=False)
+        return found
+
+    async def resolve(self, session, entries: list) -> List[dict]:
+        # The *_html values for each ORM entry, in order
+        refs = [cell_refs(entry) for entry in entries]
+        fragments = await self.fetch(
+            session, (i for row in refs for r in row for i in decode_refs(r))
+        )
+        return [
+            {
+                name: join_cell(resolve_cell(fragments, r))
+                for name, r in zip(HTML_COLUMNS, row)
+            }
+            for row in refs
+        ]
+
+
+fragment_cache = FragmentCache()
@@ -0,0 +1,188 @@
+import hashlib
+import time
+import zlib
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+from typing import AsyncIterator, Callable, Optional
+
+from fastapi import Request, Response
+from fastapi.responses import StreamingResponse
+
+from catalogue import catalogue
+from metrics import span
+
+try:
+    import brotli
+except ImportError:  # brotli is optional; gzip is always available
+    brotli = None
+
+COMPRESSED_CACHE_BYTES = 32 * 1024 * 1024
+# Bigger bodies are compressed on the fly every time rather than cached
+COMPRESSED_ENTRY_MAX_BYTES = 4 * 1024 * 1024
+# data_version.modified_at has whole-second resolution, so a write later in
+# the same second (or one still committing) could share the timestamp.
+# Last-Modified is only sent and honoured once that second has safely passed;
+# until then clients revalidate with the ETag alone.
+LAST_MODIFIED_SETTLE_SECONDS = 2
+
+
+async def make_etag(request: Request) -> str:
+    # One strong ETag per data version and filter combination. Syncs the
+    # catalogue first, so the data served next is at least this new.
+    state = await catalogue.sync()
+    request.state.last_modified = state.modified_at
+    key = f"{state.epoch}:{state.version}:{request.url.path}?{request.url.query}"
+    return '"' + hashlib.sha1(key.encode()).hexdigest() + '"'
+
+
+def encoded_etag(etag: str, encoding: Optional[str]) -> str:
+    # Compressed representations carry the encoding as a suffix
+    if encoding is None:
+        return etag
+    return f'{etag[:-1]}-{encoding}"'
+
+
+def _etag_matches(header: str, etag: str) -> bool:
+    for tag in header.split(","):
+        tag = tag.strip()
+        if tag == "*" or tag.removeprefix("W/") == etag:
+            return True
+    return False
+
+
+def _last_modified(request: Request) -> Optional[int]:
+    last_modified = request.state.last_modified
+    if time.time() < last_modified + LAST_MODIFIED_SETTLE_SECONDS:
+        return None
+    return last_modified
+
+
+def cache_headers(request: Request, etag: str) -> dict:
+    headers = {
+        "ETag": etag,
+        "Cache-Control": "no-cache",
+        "Vary": "Accept-Encoding",
+    }
+    last_modified = _last_modified(request)
+    if last_modified is not None:
+        headers["Last-Modified"] = formatdate(last_modified, usegmt=True)
+    return headers
+
+
+def not_modified(request: Request, etag: str) -> Optional[Response]:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        matched = _etag_matches(if_none_match, etag)
+    else:
+        if_modified_since = request.headers.get("if-modified-since")
+        last_modified = _last_modified(request)
+        if if_modified_since is None or last_modified is None:
+            return None
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return None
+        matched = last_modified <= since
+    if matched:
+        return Response(status_code=304, headers=cache_headers(request, etag))
+    return None
+
+
+def preferred_encoding(request: Request) -> Optional[str]:
+    accepted = set()
+    for part in request.headers.get("accept-encoding", "").split(","):
+        coding, _, params = part.partition(";")
+        name, _, value = params.partition("=")
+        if name.strip() == "q":
+            try:
+                if float(value) == 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(coding.strip().lower())
+    if brotli is not None and "br" in accepted:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return None
+
+
+class CompressedBodyCache:
+    # Compressed bodies keyed by (ETag, encoding). A new catalogue version
+    # produces new ETags, so stale entries simply age out of the LRU.
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[tuple, bytes]" = OrderedDict()
+        self._size = 0
+
+    def get(self, etag: str, encoding: str) -> Optional[bytes]:
+        body = self._entries.get((etag, encoding))
+        if body is not None:
+            self._entries.move_to_end((etag, encoding))
+        return body
+
+    def put(self, etag: str, encoding: str, body: bytes):
+        if len(body) > self.max_bytes:
+            return
+        previous = self._entries.pop((etag, encoding), None)
+        if previous is not None:
+            self._size -= len(previous)
+        self._entries[(etag, encoding)] = body
+        self._size += len(body)
+        while self._size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._size -= len(evicted)
+
+
+compressed_bodies = CompressedBodyCache(COMPRESSED_CACHE_BYTES)
+
+
+async def _compress(
+    chunks: AsyncIterator[str], etag: str, encoding: str
+) -> AsyncIterator[bytes]:
+    # Compresses the body as it is rendered, keeping a copy for the cache
+    # while it stays under COMPRESSED_ENTRY_MAX_BYTES
+    if encoding == "br":
+        compressor = brotli.Compressor()
+        compress, finish = compressor.process, compressor.finish
+    else:
+        compressor = zlib.compressobj(wbits=31)  # gzip framing
+        compress, finish = compressor.compress, compressor.flush
+    kept, size = [], 0
+    async for chunk in chunks:
+        with span("compress"):
+            data = compress(chunk.encode())
+        if data:
+            if kept is not None:
+                kept.append(data)
+                size += len(data)
+                if size > COMPRESSED_ENTRY_MAX_BYTES:
+                    kept = None
+            yield data
+    data = finish()
+    yield data
+    if kept is not None:
+        compressed_bodies.put(etag, encoding, b"".join(kept) + data)
+
+
+async def compressed_response(
+    request: Request,
+    etag: str,
+    render: Callable[[], AsyncIterator[str]],
+    media_type: str,
+) -> Optional[Response]:
+    # Streams the compressed body on a miss; later requests for the same
+    # representation are served straight from the cache.
+    encoding = preferred_encoding(request)
+    if encoding is None:
+        return None
+    headers = cache_headers(request, etag)
+    headers["ETag"] = encoded_etag(etag, encoding)
+    headers["Content-Encoding"] = encoding
+    body = compressed_bodies.get(etag, encoding)
+    if body is None:
+        return StreamingResponse(
+            _compress(render(), etag, encoding), media_type=media_type, headers=headers
+        )
+    return Response(content=body, media_type=media_type, headers=headers)
@@ -1,15 +1,68 @@
 import asyncio
-import re
-from typing import List, Optional
+from contextlib import asynccontextmanager
+from typing import Dict, List, Literal, Optional
 
-from fastapi import FastAPI, Form, HTTPException, Query, Request
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi import FastAPI, Form, HTTPException, Query, Request, Response
+from fastapi.responses import (
+    HTMLResponse,
+    PlainTextResponse,
+    RedirectResponse,
+    StreamingResponse,
+)
+from sqlalchemy import update
 from sqlalchemy.future import select
 
-from db import AsyncSessionLocal
-from models import CanonMediaEntry, CanonMediaEntrySchema
+from catalogue import CATALOGUE_CACHE, catalogue, fetch_data_version
+from db import AsyncSessionLocal, engine, write_lock
+from http_cache import (
+    cache_headers,
+    compressed_response,
+    encoded_etag,
+    make_etag,
+    not_modified,
+    preferred_encoding,
+)
+from metrics import METRICS, MetricsMiddleware, render_metrics
+from migrations import migrate
+from models import (
+    BulkWatchedResult,
+    BulkWatchedUpdate,
+    CanonMediaEntry,
+    CanonMediaEntrySchema,
+    MediaFilter,
+    StatsBucket,
+)
+from queries import (
+    bulk_watched_query,
+    fetch_content_types,
+    fetch_media,
+    fetch_media_page,
+    fetch_stats,
+    iter_media_batches,
+    selected_ids_query,
+    stream_media,
+    user_watched_query,
+)
+from render import render_filter_form, render_media_table
+from snapshot import CATALOGUE_SNAPSHOT, restore_if_empty
 
-app = FastAPI()
+MAX_PAGE_SIZE = 1000
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await migrate(engine)
+    entries = None
+    if CATALOGUE_SNAPSHOT:
+        entries = await restore_if_empty(CATALOGUE_SNAPSHOT)
+    if CATALOGUE_CACHE:
+        await catalogue.load(entries)
+    yield
+
+
+app = FastAPI(lifespan=lifespan)
+if METRICS:
+    app.add_middleware(MetricsMiddleware)
 
 
 async def get_all_media():
@@ -24,21 +77,13 @@ async def save_media_entry(entry):
         await session.commit()
 
 
-def parse_year(year_str):
-    if not year_str:
-        return None
-    match = re.search(r"(-?\d+)(?:\s*(BBY|ABY))?", year_str)
-    if match:
-        value = int(match.group(1))
-        era = match.group(2)
-        # BBY is negative, ABY is positive
-        if era == "BBY":
-            return -abs(value)
-        elif era == "ABY":
-            return abs(value)
-        else:
-            return value
-    return None
+# async so rendering runs on the event loop, which is the only place the
+# metrics are updated; from the threadpool it could race new label series
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    return PlainTextResponse(
+        render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
 
 
 @app.get("/")
@@ -48,39 +93,148 @@ def read_root():
 
 @app.get("/media", response_model=List[CanonMediaEntrySchema])
 async def get_media(
+    request: Request,
+    response: Response,
     content_type: Optional[List[str]] = Query(None),
     watched: Optional[bool] = Query(None),
+    user_id: Optional[str] = Query(
+        None,
+        min_length=1,
+        max_length=64,
+        description="Resolve watched from this user's progress",
+    ),
     id_gt: Optional[int] = Query(None),
     id_lt: Optional[int] = Query(None),
+    year_from: Optional[int] = Query(None, description="Earliest in-universe year"),
+    year_to: Optional[int] = Query(None, description="Latest in-universe year"),
+    q: Optional[str] = Query(
+        None, description="Search titles, episode titles and types by word prefix"
+    ),
+    order: Optional[Literal["id", "year", "rank"]] = Query(
+        None, description="Defaults to rank when searching, otherwise id"
+    ),
+    after: Optional[str] = Query(
+        None, description="X-Next-Cursor value from the previous page"
+    ),
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    stream: bool = Query(False, description="Stream all matches as NDJSON"),
 ):
-    media_data = await get_all_media()
-    # Convert to Pydantic models for safe attribute access
-    result = [CanonMediaEntrySchema.model_validate(m) for m in media_data]
-    if content_type:
-        result = [m for m in result if m.content_type in content_type]
-    if watched is not None:
-        result = [m for m in result if m.watched == watched]
-    if id_gt is not None:
-        result = [m for m in result if m.id is not None and m.id > id_gt]
-    if id_lt is not None:
-        result = [m for m in result if m.id is not None and m.id < id_lt]
-    return result
+    etag = await make_etag(request)
+    if cached := not_modified(request, etag):
+        return cached
+    if order is None:
+        order = "rank" if q else "id"
+    elif order == "rank" and not q:
+        raise HTTPException(status_code=422, detail="order=rank requires q")
+    after_year = after_id = offset = None
+    if after is not None:
+        try:
+            if order == "year":
+                after_year, after_id = map(int, after.split(":"))
+            elif order == "rank":
+                offset = int(after)
+            else:
+                after_id = int(after)
+        except ValueError:
+            raise HTTPException(status_code=422, detail="Invalid cursor")
+    lower_bounds = [b for b in (id_gt, after_id) if b is not None]
+    filters = MediaFilter(
+        content_type=content_type,
+        watched=watched,
+        user_id=user_id,
+        id_gt=max(lower_bounds) if order == "id" and lower_bounds else id_gt,
+        id_lt=id_lt,
+        year_from=year_from,
+        year_to=year_to,
+        q=q,
+        order=order,
+        after_year=after_year,
+        after_id=after_id if order == "year" else None,
+        offset=offset,
+        limit=limit,
+    )
+    if stream:
+        return StreamingResponse(
+            stream_media(filters),
+            media_type="application/x-ndjson",
+            headers=cache_headers(request, etag),
+        )
+    response.headers.update(cache_headers(request, etag))
+    if limit is None:
+        return await fetch_media(filters)
+    rows, next_cursor = await fetch_media_page(filters)
+    if next_cursor is not None:
+        next_url = request.url.include_query_params(after=next_cursor)
+        response.headers["X-Next-Cursor"] = next_cursor
+        response.headers["Link"] = f'<{next_url}>; rel="next"'
+    return rows
+
+
+async def set_user_watched(selection: BulkWatchedUpdate) -> List[int]:
+    async with write_lock, AsyncSessionLocal() as session:
+        result = await session.execute(selected_ids_query(selection))
+        ids = sorted(result.scalars())
+        if ids:
+            await session.execute(user_watched_query(selection))
+        await session.commit()
+    return ids
+
+
+@app.get("/stats", response_model=Dict[str, List[StatsBucket]])
+async def get_stats(
+    request: Request,
+    response: Response,
+    recompute: bool = Query(
+        False, description="Aggregate canon_media from scratch to verify counters"
+    ),
+):
+    etag = await make_etag(request)
+    if cached := not_modified(request, etag):
+        return cached
+    response.headers.update(cache_headers(request, etag))
+    return await fetch_stats(recompute)
+
+
+@app.post("/media/watched", response_model=BulkWatchedResult)
+async def update_watched_bulk(selection: BulkWatchedUpdate):
+    if selection.user_id is not None:
+        ids = await set_user_watched(selection)
+        return BulkWatchedResult(watched=selection.watched, updated=len(ids), ids=ids)
+    async with write_lock, AsyncSessionLocal() as session:
+        result = await session.execute(bulk_watched_query(selection))
+        ids = sorted(result.scalars())
+        state = await fetch_data_version(session)
+        await session.commit()
+    catalogue.set_watched(ids, selection.watched, state)
+    return BulkWatchedResult(watched=selection.watched, updated=len(ids), ids=ids)
 
 
 @app.post("/media/{media_id}/watched")
 async def update_watched(
-    media_id: int, watched: bool = Form(...), request: Request = None
+    media_id: int,
+    watched: bool = Form(...),
+    user_id: Optional[str] = Form(None, min_length=1, max_length=64),
+    request: Request = None,
 ):
-    async with AsyncSessionLocal() as session:
-        result = await session.execute(
-            select(CanonMediaEntry).where(CanonMediaEntry.id == media_id)
-        )
-        entry = result.scalar_one_or_none()
-        if entry:
-            setattr(entry, "watched", watched)
+    if user_id is not None:
+        selection = BulkWatchedUpdate(watched=watched, user_id=user_id, ids=[media_id])
+        if not await set_user_watched(selection):
+            raise HTTPException(status_code=404, detail="Media entry not found")
+    else:
+        async with write_lock, AsyncSessionLocal() as session:
+            result = await session.execute(
+                update(CanonMediaEntry)
+                .where(CanonMediaEntry.id == media_id)
+                .values(watched=watched)
+            )
+            state = await fetch_data_version(session)
             await session.commit()
-        else:
+        if not result.rowcount:
             raise HTTPException(status_code=404, detail="Media entry not found")
+        catalogue.set_watched([media_id], watched, state)
+    # The table page toggles rows in place with fetch() and asks for JSON
+    if "application/json" in request.headers.get("accept", ""):
+        return {"id": media_id, "watched": watched}
     # Preserve query parameters in redirect
     query_string = request.headers.get("referer", "")
     if "?" in query_string:
@@ -96,11 +250,15 @@ async def media_table(
     watched: Optional[str] = Query(None),
     id_gt: Optional[str] = Query(None),
     id_lt: Optional[str] = Query(None),
+    q: Optional[str] = Query(None),
+    plain: bool = Query(
+        False, description="Render text columns only, without the wiki HTML"
+    ),
 ):
-    media_data = await get_all_media()
-    entries = [CanonMediaEntrySchema.model_validate(m) for m in media_data]
-    filtered = entries
-    types = sorted(set(m.content_type for m in entries if m.content_type))
+    etag = await make_etag(request)
+    # A 304 must carry the same ETag as the representation it stands for
+    if cached := not_modified(request, encoded_etag(etag, preferred_encoding(request))):
+        return cached
     selected_types = request.query_params.getlist("content_type")
     # Handle empty/All for filters
     content_type_val = (
@@ -113,58 +271,28 @@ async def media_table(
         watched_val = False
     id_gt_val = int(id_gt) if id_gt and id_gt.strip() else None
     id_lt_val = int(id_lt) if id_lt and id_lt.strip() else None
-    if content_type_val:
-        filtered = [m for m in filtered if m.content_type in content_type_val]
-    if watched_val is not None:
-        filtered = [m for m in filtered if m.watched == watched_val]
-    if id_gt_val is not None:
-        filtered = [m for m in filtered if m.id is not None and m.id > id_gt_val]
-    if id_lt_val is not None:
-        filtered = [m for m in filtered if m.id is not None and m.id < id_lt_val]
-    table_html = """
-    <form method='get'>
-        <label>Filter by type:</label>
-        <select name='content_type' multiple size='10' onchange='if([...this.options].every(opt=>!opt.selected)){this.form.removeAttribute("action");this.form.submit();}else{this.form.submit();}'>
-    """
-    for t in types:
-        selected = "selected" if t in selected_types else ""
-        table_html += f"<option value='{t}' {selected}>{t}</option>"
-    table_html += """
-        </select>
-        <label>Watched:</label>
-        <select name='watched' onchange='if(this.value==""){{this.form.removeAttribute("action");this.form.submit();}}else{{this.form.submit();}}'>
-            <option value=''>All</option>
-            <option value='true' {}>Watched</option>
-            <option value='false' {}>Unwatched</option>
-        </select>
-        <label>ID greater than:</label>
-        <input type='number' name='id_gt' value='{}' onchange='if(this.value==""){{this.form.removeAttribute("action");this.form.submit();}}else{{this.form.submit();}}'>
-        <label>ID less than:</label>
-        <input type='number' name='id_lt' value='{}' onchange='if(this.value==""){{this.form.removeAttribute("action");this.form.submit();}}else{{this.form.submit();}}'>
-    </form>
-    <table border='1'>
-        <tr><th>ID</th><th>Year</th><th>Type</th><th>Title</th><th>Season</th><th>Episode</th><th>Released</th><th>Watched</th><th>Action</th></tr>
-    """.format(
-        "selected" if watched_val is True else "",
-        "selected" if watched_val is False else "",
-        id_gt if id_gt is not None else "",
-        id_lt if id_lt is not None else "",
+    types = await fetch_content_types()
+    form_html = render_filter_form(
+        types, selected_types, watched_val, id_gt, id_lt, q, plain
+    )
+    filters = MediaFilter(
+        content_type=content_type_val,
+        watched=watched_val,
+        id_gt=id_gt_val,
+        id_lt=id_lt_val,
+        q=q,
+        order="rank" if q else "id",
+        include_html=not plain,
     )
-    for m in filtered:
-        query_str = request.url.query
-        action_url = f"/media/{m.id}/watched"
-        if query_str:
-            action_url += f"?{query_str}"
-        table_html += f"<tr><td>{m.id}</td>"
-        table_html += f"<td>{m.year_html if m.year_html else m.year}</td>"
-        table_html += (
-            f"<td>{m.content_type_html if m.content_type_html else m.content_type}</td>"
+
+    def render():
+        return render_media_table(
+            form_html, iter_media_batches(filters), request.url.query, plain
         )
-        table_html += f"<td>{m.title_html if m.title_html else m.title}{f' -- {m.episode_title}' if not m.title_html and m.episode_title else ''}</td>"
-        table_html += f"<td>{m.season}</td>"
-        table_html += f"<td>{m.episode}</td>"
-        table_html += f"<td>{m.released_html if m.released_html else m.released}</td>"
-        table_html += f"<td>{'Yes' if m.watched else 'No'}</td>"
-        table_html += f"<td><form method='post' action='{action_url}'><input type='hidden' name='watched' value='{str(not m.watched).lower()}'><button type='submit'>{'Mark Unwatched' if m.watched else 'Mark Watched'}</button></form></td></tr>"
-    table_html += "</table>"
-    return table_html
+
+    compressed = await compressed_response(request, etag, render, "text/html")
+    if compressed is not None:
+        return compressed
+    return StreamingResponse(
+        render(), media_type="text/html", headers=cache_headers(request, etag)
+    )
@@ -0,0 +1,340 @@
+from typing import Iterator, NamedTuple, Optional
+
+from bs4 import BeautifulSoup, Tag
+
+from models import make_natural_key
+
+WIKI_ORIGIN = "https://starwars.fandom.com"
+
+
+class ParsedRow(NamedTuple):
+    year: Optional[str]
+    year_html: Optional[str]
+    content_type: Optional[str]
+    content_type_html: Optional[str]
+    title: Optional[str]
+    title_html: Optional[str]
+    episode_title: Optional[str]
+    episode_url: Optional[str]
+    released: Optional[str]
+    released_html: Optional[str]
+
+    @property
+    def natural_key(self) -> str:
+        return make_natural_key(
+            self.year, self.content_type, self.title, self.episode_title, self.released
+        )
+
+
+def parse_with_bs4(path: str) -> Iterator[ParsedRow]:
+    with open(path, encoding="utf-8") as html_file:
+        soup = BeautifulSoup(html_file, "html.parser")
+    for table in soup.find_all("table"):
+        if not isinstance(table, Tag):
+            continue
+        headers = [
+            th.get_text(strip=True)
+            for th in table.find_all("th")
+            if isinstance(th, Tag)
+        ]
+        if "Year" in headers and "Title" in headers and "Released" in headers:
+            for row in table.find_all("tr")[1:]:
+                if not isinstance(row, Tag):
+                    continue
+                cells = [
+                    cell for cell in row.find_all(["td", "th"]) if isinstance(cell, Tag)
+                ]
+                if len(cells) >= 4:
+                    year_cell = cells[0]
+                    type_cell = cells[1]
+                    title_cell = cells[2]
+                    released_cell = cells[3]
+
+                    # Prepend local hrefs in all cells
+                    for cell in [year_cell, type_cell, title_cell, released_cell]:
+                        if cell:
+                            for a in cell.find_all("a", href=True):
+                                if isinstance(a, Tag):
+                                    href = a.get("href")
+                                    if (
+                                        isinstance(href, str)
+                                        and href.startswith("/")
+                                        and not href.startswith("//")
+                                    ):
+                                        a.attrs["href"] = f"{WIKI_ORIGIN}{href}"
+
+                    # For year (cell 0)
+                    year = year_cell.get_text(strip=True) if year_cell else None
+                    year_html = year_cell.decode_contents() if year_cell else None
+                    # For content_type (cell 1)
+                    content_type = type_cell.get_text(strip=True) if type_cell else None
+                    content_type_html = (
+                        type_cell.decode_contents() if type_cell else None
+                    )
+                    # For title and episode_title (cell 2)
+                    title = None
+                    episode_title = None
+                    episode_url = None
+                    title_html = None
+                    # Remove direct child <span> elements from title_cell only if they contain a descendant 'a' tag with 'data-image-name'
+                    if isinstance(title_cell, Tag):
+                        for span in list(title_cell.find_all("span", recursive=False)):
+                            if not isinstance(span, Tag):
+                                continue
+                            has_image_img = False
+                            for img in span.find_all("img"):
+                                if (
+                                    isinstance(img, Tag)
+                                    and "data-image-name" in img.attrs
+                                ):
+                                    has_image_img = True
+                                    break
+                            if has_image_img and img.parent and img.parent.parent:
+                                img.parent.parent.decompose()
+                                # span.decompose()
+                        title_html = title_cell.decode_contents()
+                        a_tags = [
+                            a
+                            for a in title_cell.find_all("a")
+                            if isinstance(a, Tag) and a.get("title")
+                        ]
+                        if len(a_tags) >= 2:
+                            title = a_tags[-2].get("title")
+                            episode_title = a_tags[-1].get("title")
+                            episode_url = a_tags[-1].get("href")
+                        elif len(a_tags) == 1:
+                            title = a_tags[0].get("title")
+                            episode_url = a_tags[0].get("href")
+                        if title is None and title_cell.get("title"):
+                            title = title_cell.get("title")
+
+                    # For released (cell 3)
+                    released = (
+                        released_cell.get_text(strip=True) if released_cell else None
+                    )
+                    released_html = (
+                        released_cell.decode_contents() if released_cell else None
+                    )
+
+                    yield ParsedRow(
+                        year=year or None,
+                        year_html=year_html,
+                        content_type=content_type or None,
+                        content_type_html=content_type_html,
+                        title=title,
+                        title_html=title_html,
+                        episode_title=episode_title,
+                        episode_url=episode_url,
+                        released=released or None,
+                        released_html=released_html,
+                    )
+
+
+# lxml backend: streams <tr> elements out of iterparse and serialises cells the
+# same way BeautifulSoup's decode_contents() does, rewriting /wiki hrefs on the
+# fly instead of mutating the tree.
+VOID_ELEMENTS = {
+    "area",
+    "base",
+    "br",
+    "col",
+    "embed",
+    "hr",
+    "img",
+    "input",
+    "keygen",
+    "link",
+    "menuitem",
+    "meta",
+    "param",
+    "source",
+    "track",
+    "wbr",
+}
+# Attributes BeautifulSoup splits on whitespace and re-joins with one space
+MULTI_VALUED_ATTRIBUTES = {
+    "class",
+    "rel",
+    "rev",
+    "accept-charset",
+    "headers",
+    "accesskey",
+    "dropzone",
+}
+
+
+ASCII_SPACES = " \n\t\x0c\r"
+
+
+def _rewrite_href(href):
+    if href is not None and href.startswith("/") and not href.startswith("//"):
+        return f"{WIKI_ORIGIN}{href}"
+    return href
+
+
+def _escape_text(text: str) -> str:
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+def _collapse_blank(text: str) -> str:
+    # BeautifulSoup stores whitespace-only strings as a single newline or space
+    if not text.strip(ASCII_SPACES):
+        return "\n" if "\n" in text else " "
+    return text
+
+
+def _quote_attribute(value: str) -> str:
+    value = _escape_text(value)
+    if '"' in value:
+        if "'" in value:
+            return '"' + value.replace('"', "&quot;") + '"'
+        return "'" + value + "'"
+    return '"' + value + '"'
+
+
+def _serialize(el, skipped, out):
+    if not isinstance(el.tag, str):
+        if el.tag.__name__ == "Comment":
+            out.append(f"<!--{el.text or ''}-->")
+        return
+    attrs = []
+    # BeautifulSoup's default formatter writes attributes in sorted order
+    for name, value in sorted(el.attrib.items()):
+        value = value or ""
+        if name in MULTI_VALUED_ATTRIBUTES:
+            value = " ".join(value.split())
+        elif name == "href" and el.tag == "a":
+            value = _rewrite_href(value)
+        attrs.append(f" {name}={_quote_attribute(value)}")
+    if el.tag in VOID_ELEMENTS and not len(el) and not el.text:
+        out.append(f"<{el.tag}{''.join(attrs)}/>")
+        return
+    out.append(f"<{el.tag}{''.join(attrs)}>")
+    _serialize_contents(el, skipped, out)
+    out.append(f"</{el.tag}>")
+
+
+def _serialize_contents(el, skipped, out):
+    if el.text:
+        out.append(_escape_text(_collapse_blank(el.text)))
+    for child in el:
+        if child not in skipped:
+            _serialize(child, skipped, out)
+        if child.tail:
+            out.append(_escape_text(_collapse_blank(child.tail)))
+
+
+def _decode_contents(el, skipped=frozenset()) -> str:
+    out = []
+    _serialize_contents(el, skipped, out)
+    return "".join(out)
+
+
+def _iter_text(el, skipped):
+    if el.text:
+        yield el.text
+    for child in el:
+        if isinstance(child.tag, str) and child not in skipped:
+            yield from _iter_text(child, skipped)
+        if child.tail:
+            yield child.tail
+
+
+def _stripped_text(el, skipped=frozenset()) -> str:
+    return "".join(s.strip() for s in _iter_text(el, skipped) if s.strip())
+
+
+def _iter_elements(el, tag, skipped):
+    for child in el:
+        if not isinstance(child.tag, str) or child in skipped:
+            continue
+        if child.tag == tag:
+            yield child
+        yield from _iter_elements(child, tag, skipped)
+
+
+def _row_from_cells(cells) -> ParsedRow:
+    year_cell, type_cell, title_cell, released_cell = cells[:4]
+    # Direct child <span>s holding a data-image-name <img> lose the img's
+    # grandparent, exactly as the BeautifulSoup path decomposes it
+    skipped = set()
+    for span in title_cell:
+        if span.tag != "span":
+            continue
+        for img in span.iter("img"):
+            if "data-image-name" in img.attrib:
+                parent = img.getparent()
+                if parent is not None and parent.getparent() is not None:
+                    skipped.add(parent.getparent())
+                break
+    title = None
+    episode_title = None
+    episode_url = None
+    a_tags = [a for a in _iter_elements(title_cell, "a", skipped) if a.get("title")]
+    if len(a_tags) >= 2:
+        title = a_tags[-2].get("title")
+        episode_title = a_tags[-1].get("title")
+        episode_url = _rewrite_href(a_tags[-1].get("href"))
+    elif len(a_tags) == 1:
+        title = a_tags[0].get("title")
+        episode_url = _rewrite_href(a_tags[0].get("href"))
+    if title is None and title_cell.get("title"):
+        title = title_cell.get("title")
+    return ParsedRow(
+        year=_stripped_text(year_cell) or None,
+        year_html=_decode_contents(year_cell),
+        content_type=_stripped_text(type_cell) or None,
+        content_type_html=_decode_contents(type_cell),
+        title=title,
+        title_html=_decode_contents(title_cell, skipped),
+        episode_title=episode_title,
+        episode_url=episode_url,
+        released=_stripped_text(released_cell) or None,
+        released_html=_decode_contents(released_cell),
+    )
+
+
+def parse_with_lxml(path: str) -> Iterator[ParsedRow]:
+    from lxml import etree
+
+    # Per open <table>: header texts seen so far and whether its first <tr>
+    # (the header row) has gone by.
+    tables = []
+    for event, el in etree.iterparse(
+        path,
+        events=("start", "end"),
+        tag=("table", "tr", "th"),
+        html=True,
+        encoding="utf-8",
+    ):
+        if el.tag == "table":
+            if event == "start":
+                tables.append({"headers": [], "seen_header_row": False})
+            else:
+                tables.pop()
+                el.clear()
+            continue
+        if event == "start" or not tables:
+            continue
+        table = tables[-1]
+        if el.tag == "th":
+            table["headers"].append(_stripped_text(el))
+            continue
+        if not table["seen_header_row"]:
+            table["seen_header_row"] = True
+            continue
+        headers = table["headers"]
+        if "Year" in headers and "Title" in headers and "Released" in headers:
+            cells = [c for c in el.iter("td", "th")]
+            if len(cells) >= 4:
+                yield _row_from_cells(cells)
+        # Drop finished rows so memory stays flat however long the table is
+        el.clear()
+        while el.getprevious() is not None:
+            del el.getparent()[0]
+
+
+PARSERS = {
+    "bs4": parse_with_bs4,
+    "lxml": parse_with_lxml,
+}
@@ -0,0 +1,216 @@
+import os
+import time
+from bisect import bisect_left
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import event
+
+METRICS = os.getenv("METRICS", "1") != "0"
+# Adds a Server-Timing header with the phases timed before the response
+# started; streamed bodies only report what ran before the first chunk.
+SERVER_TIMING = METRICS and os.getenv("SERVER_TIMING", "0") == "1"
+
+LATENCY_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+
+class Histogram:
+    # Cumulative buckets per label set, rendered in the Prometheus text format
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...], buckets):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self._series: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, *label_values: str):
+        series = self._series.get(label_values)
+        if series is None:
+            # one count per bucket plus +Inf, then the running sum
+            series = self._series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def render(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.help_text}",
+            f"# TYPE {self.name} histogram",
+        ]
+        for label_values, series in sorted(self._series.items()):
+            labels = ",".join(
+                f'{k}="{_escape(v)}"' for k, v in zip(self.labels, label_values)
+            )
+            prefix = labels + "," if labels else ""
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+            cumulative += series[len(self.buckets)]
+            lines.append(f'{self.name}_bucket{{{prefix}le="+Inf"}} {cumulative}')
+            suffix = f"{{{labels}}}" if labels else ""
+            lines.append(f"{self.name}_sum{suffix} {series[-1]}")
+            lines.append(f"{self.name}_count{suffix} {cumulative}")
+        return lines
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds",
+    "Time from receiving a request to the end of its response body.",
+    ("method", "route", "status"),
+    LATENCY_BUCKETS,
+)
+PHASE_SECONDS = Histogram(
+    "app_phase_duration_seconds",
+    "Time spent in each instrumented phase of request handling.",
+    ("phase",),
+    LATENCY_BUCKETS,
+)
+STATEMENT_SECONDS = Histogram(
+    "db_statement_duration_seconds",
+    "SQL statement execution time.",
+    ("operation",),
+    LATENCY_BUCKETS,
+)
+REQUEST_STATEMENTS = Histogram(
+    "http_request_db_statements",
+    "SQL statements executed per request.",
+    ("route",),
+    COUNT_BUCKETS,
+)
+HISTOGRAMS = [REQUEST_SECONDS, PHASE_SECONDS, STATEMENT_SECONDS, REQUEST_STATEMENTS]
+
+
+class RequestTimings:
+    __slots__ = ("phases", "statements", "statement_seconds")
+
+    def __init__(self):
+        self.phases: Dict[str, float] = {}
+        self.statements = 0
+        self.statement_seconds = 0.0
+
+    def server_timing(self, total: float) -> str:
+        entries = [
+            f"{name};dur={seconds * 1000:.2f}" for name, seconds in self.phases.items()
+        ]
+        entries.append(
+            f'db;dur={self.statement_seconds * 1000:.2f};desc="{self.statements} queries"'
+        )
+        entries.append(f"total;dur={total * 1000:.2f}")
+        return ", ".join(entries)
+
+
+_current: ContextVar[Optional[RequestTimings]] = ContextVar(
+    "request_timings", default=None
+)
+_DISABLED = nullcontext()
+
+
+@contextmanager
+def _timed(name: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        PHASE_SECONDS.observe(elapsed, name)
+        timings = _current.get()
+        if timings is not None:
+            timings.phases[name] = timings.phases.get(name, 0.0) + elapsed
+
+
+def span(name: str):
+    # Times a phase such as "validate" or "render"; a shared no-op when
+    # metrics are off
+    if not METRICS:
+        return _DISABLED
+    return _timed(name)
+
+
+def instrument_engine(engine):
+    if not METRICS:
+        return
+    sync_engine = engine.sync_engine
+
+    # The start time lives on the statement's execution context, which is
+    # dropped with it even when the statement fails and after_cursor_execute
+    # never fires
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        context._metrics_started = time.perf_counter()
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - context._metrics_started
+        operation = statement.lstrip().split(None, 1)[0].upper()
+        STATEMENT_SECONDS.observe(elapsed, operation)
+        timings = _current.get()
+        if timings is not None:
+            timings.statements += 1
+            timings.statement_seconds += elapsed
+
+
+class MetricsMiddleware:
+    # Plain ASGI middleware, so streamed responses pass straight through
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        timings = RequestTimings()
+        token = _current.set(timings)
+        started = time.perf_counter()
+        status = "500"
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = str(message["status"])
+                if SERVER_TIMING:
+                    total = time.perf_counter() - started
+                    headers = list(message.get("headers", []))
+                    headers.append(
+                        (b"server-timing", timings.server_timing(total).encode())
+                    )
+                    message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            # Observed once the body is sent, so streamed responses count in full
+            elapsed = time.perf_counter() - started
+            route = getattr(scope.get("route"), "path", "unmatched")
+            REQUEST_SECONDS.observe(elapsed, scope["method"], route, status)
+            REQUEST_STATEMENTS.observe(timings.statements, route)
+            _current.reset(token)
+
+
+def render_metrics() -> str:
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.render())
+    return "\n".join(lines) + "\n"
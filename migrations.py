@@ -0,0 +1,164 @@
+from sqlalchemy import inspect, text
+
+from chronology import year_sort_keys
+from fragments import intern_fragments, normalize_row
+from models import (
+    CONTENT_COLUMNS,
+    FTS_SCHEMA,
+    HTML_COLUMNS,
+    MEDIA_VERSION_SCHEMA,
+    STATS_RECOMPUTE,
+    STATS_SCHEMA,
+    WATCH_STATE_VERSION_SCHEMA,
+    Base,
+    make_content_hash,
+    refs_column,
+)
+
+
+def _backfill_year_sort(conn):
+    rows = conn.execute(text("SELECT id, year FROM canon_media ORDER BY id")).all()
+    keys = year_sort_keys(year for _, year in rows)
+    conn.execute(
+        text("UPDATE canon_media SET year_sort = :year_sort WHERE id = :id"),
+        [{"id": media_id, "year_sort": key} for (media_id, _), key in zip(rows, keys)],
+    )
+
+
+def _backfill_content_hash(conn):
+    columns = ", ".join(CONTENT_COLUMNS)
+    rows = conn.execute(text(f"SELECT id, {columns} FROM canon_media")).mappings()
+    conn.execute(
+        text("UPDATE canon_media SET content_hash = :content_hash WHERE id = :id"),
+        [{"id": row["id"], "content_hash": make_content_hash(row)} for row in rows],
+    )
+
+
+def _intern_html(conn):
+    # The archive may already have been created with the refs columns, by
+    # create_all on a database older than migration 6
+    for table in ("canon_media", "canon_media_removed"):
+        existing = {c["name"] for c in inspect(conn).get_columns(table)}
+        if "year_html" not in existing:
+            continue
+        for name in HTML_COLUMNS:
+            conn.execute(
+                text(f"ALTER TABLE {table} ADD COLUMN {refs_column(name)} VARCHAR(512)")
+            )
+        columns = ", ".join(CONTENT_COLUMNS)
+        rows = conn.execute(text(f"SELECT id, {columns} FROM {table}")).mappings()
+        values = []
+        for row in rows:
+            row = normalize_row(dict(row))
+            row["content_hash"] = make_content_hash(row)
+            values.append(row)
+        intern_fragments(conn, values)
+        if values:
+            assignments = ", ".join(
+                f"{c} = :{c}" for c in (*map(refs_column, HTML_COLUMNS), "content_hash")
+            )
+            conn.execute(
+                text(f"UPDATE {table} SET {assignments} WHERE id = :id"), values
+            )
+        for name in HTML_COLUMNS:
+            conn.execute(text(f"ALTER TABLE {table} DROP COLUMN {name}"))
+
+
+# Schema changes for databases created by older versions of the app. Each step
+# is a list of SQL statements or sync callables (run via ``run_sync``) and is
+# applied once, in order; the number of applied steps is kept in SQLite's
+# ``user_version`` pragma. Fresh databases get the full schema from the models
+# and are stamped with the latest version straight away.
+MIGRATIONS = [
+    # 1: composite indexes backing the /media filters
+    [
+        "CREATE INDEX IF NOT EXISTS ix_canon_media_content_type_watched_id "
+        "ON canon_media (content_type, watched, id)",
+        "CREATE INDEX IF NOT EXISTS ix_canon_media_watched_id "
+        "ON canon_media (watched, id)",
+    ],
+    # 2: natural key for the bulk importer. Earlier imports stored empty
+    # year/content_type/released as NULL but looked them up as '', so re-runs
+    # could duplicate rows; merge those into the oldest copy first.
+    [
+        "ALTER TABLE canon_media ADD COLUMN natural_key VARCHAR(1024)",
+        "UPDATE canon_media SET natural_key = "
+        "coalesce(year, '') || char(31) || coalesce(content_type, '') || char(31) "
+        "|| coalesce(title, '') || char(31) || coalesce(episode_title, '') "
+        "|| char(31) || coalesce(released, '')",
+        "UPDATE canon_media SET watched = 1 WHERE id IN ("
+        "SELECT min(id) FROM canon_media GROUP BY natural_key "
+        "HAVING count(*) > 1 AND max(watched) = 1)",
+        "DELETE FROM canon_media WHERE id NOT IN ("
+        "SELECT min(id) FROM canon_media GROUP BY natural_key)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS ux_canon_media_natural_key "
+        "ON canon_media (natural_key)",
+    ],
+    # 3: numeric chronology key parsed from the free-form year
+    [
+        "ALTER TABLE canon_media ADD COLUMN year_sort INTEGER",
+        _backfill_year_sort,
+        "CREATE INDEX IF NOT EXISTS ix_canon_media_year_sort_id "
+        "ON canon_media (year_sort, id)",
+    ],
+    # 4: full-text search index, filled from the existing rows
+    [
+        *FTS_SCHEMA,
+        "INSERT INTO canon_media_fts (canon_media_fts) VALUES ('rebuild')",
+    ],
+    # 5: progress counters for /stats, seeded from the existing rows (with
+    # the current STATS_DIMENSIONS; migration 9 redoes it for older seeds)
+    [
+        *STATS_SCHEMA,
+        "INSERT INTO media_stats (dimension, bucket, total, watched) "
+        + STATS_RECOMPUTE,
+    ],
+    # 6: content hashes for incremental re-imports (the canon_media_removed
+    # archive is a new table, so create_all adds it)
+    [
+        "ALTER TABLE canon_media ADD COLUMN content_hash VARCHAR(40)",
+        _backfill_content_hash,
+    ],
+    # 7: *_html cells moved into the html_fragments dictionary (a new table,
+    # so create_all adds it); whitespace is normalized and hashes redone
+    [_intern_html],
+    # 8: change counters for HTTP validators and catalogue reloads
+    [*MEDIA_VERSION_SCHEMA, *WATCH_STATE_VERSION_SCHEMA],
+    # 9: season counters bucketed per series; the stats triggers are
+    # recreated and the counters reseeded
+    [
+        "DROP TRIGGER IF EXISTS media_stats_ai",
+        "DROP TRIGGER IF EXISTS media_stats_ad",
+        "DROP TRIGGER IF EXISTS media_stats_au",
+        *STATS_SCHEMA,
+        "DELETE FROM media_stats",
+        "INSERT INTO media_stats (dimension, bucket, total, watched) "
+        + STATS_RECOMPUTE,
+    ],
+]
+# Migrating past this version frees enough pages to be worth a VACUUM
+VACUUM_BEFORE = 7
+
+
+async def migrate(engine):
+    async with engine.begin() as conn:
+        existing = await conn.run_sync(
+            lambda sync_conn: inspect(sync_conn).has_table("canon_media")
+        )
+        await conn.run_sync(Base.metadata.create_all)
+        if not existing:
+            await conn.execute(text(f"PRAGMA user_version = {len(MIGRATIONS)}"))
+            return
+        version = (await conn.execute(text("PRAGMA user_version"))).scalar_one()
+        for step_version, steps in enumerate(MIGRATIONS[version:], start=version + 1):
+            for step in steps:
+                if callable(step):
+                    await conn.run_sync(step)
+                else:
+                    await conn.execute(text(step))
+            await conn.execute(text(f"PRAGMA user_version = {step_version}"))
+    if version < VACUUM_BEFORE:
+        # VACUUM can't run inside a transaction
+        async with engine.connect() as conn:
+            conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+            await conn.execute(text("VACUUM"))
@@ -1,49 +1,427 @@
-from typing import Optional
+import hashlib
+import json
+from typing import Annotated, List, Literal, Optional
 
-from pydantic import BaseModel
-from sqlalchemy import Boolean, Column, Integer, String
+from pydantic import BaseModel, Field, model_validator
+from sqlalchemy import (
+    DDL,
+    Boolean,
+    Column,
+    DateTime,
+    ForeignKey,
+    Index,
+    Integer,
+    String,
+    column,
+    event,
+    func,
+    table,
+)
 from sqlalchemy.ext.declarative import declarative_base
 
 Base = declarative_base()
 
+NATURAL_KEY_SEPARATOR = "\x1f"
 
-class CanonMediaEntry(Base):
-    __tablename__ = "canon_media"
 
+def make_natural_key(year, content_type, title, episode_title, released) -> str:
+    # Must stay in step with the SQL backfill in migrations.py
+    return NATURAL_KEY_SEPARATOR.join(
+        v or "" for v in (year, content_type, title, episode_title, released)
+    )
+
+
+class MediaColumns:
+    # Shared by canon_media and its canon_media_removed archive
     id = Column(Integer, primary_key=True, autoincrement=True)
     year = Column(
         String(32), nullable=True
     )  # e.g. '382 BBY', '0 ABY', 'c. 232 BBY', etc.
-    year_html = Column(String(512), nullable=True)
     content_type = Column(String(64), nullable=True)  # e.g. 'C', 'TV', 'N', etc.
-    content_type_html = Column(String(512), nullable=True)
     title = Column(String(256), nullable=False)
     episode_title = Column(String(256), nullable=True)
     episode_url = Column(String(512), nullable=True)
-    title_html = Column(String(512), nullable=True)
     released = Column(
         String(64), nullable=True
     )  # e.g. '2023-04-26', '2015-09-04', etc.
-    released_html = Column(String(512), nullable=True)
+    # The *_html cells are stored as comma-separated html_fragments ids; see
+    # fragments.py. NULL means the cell had no HTML at all.
+    year_html_refs = Column(String(512), nullable=True)
+    content_type_html_refs = Column(String(512), nullable=True)
+    title_html_refs = Column(String(512), nullable=True)
+    released_html_refs = Column(String(512), nullable=True)
     watched = Column(Boolean, default=False)
     season = Column(String(8), nullable=False, default="")
     episode = Column(String(8), nullable=False, default="")
+    # year/content_type/title/episode_title/released joined by
+    # NATURAL_KEY_SEPARATOR; the importer upserts on it.
+    natural_key = Column(String(1024), nullable=True)
+    # Signed year from chronology.parse_year (BBY negative) for range queries
+    # and chronological ordering
+    year_sort = Column(Integer, nullable=True)
+    # make_content_hash of the imported CONTENT_COLUMNS; re-imports skip rows
+    # whose hash is unchanged
+    content_hash = Column(String(40), nullable=True)
+
+
+# Columns the importer refreshes from the HTML on every run; watched, season
+# and episode are never touched by an update.
+CONTENT_COLUMNS = [
+    "year",
+    "year_html",
+    "content_type",
+    "content_type_html",
+    "title",
+    "title_html",
+    "episode_title",
+    "episode_url",
+    "released",
+    "released_html",
+    "year_sort",
+]
+
+
+HTML_COLUMNS = ["year_html", "content_type_html", "title_html", "released_html"]
+
+
+def refs_column(name: str) -> str:
+    return f"{name}_refs"
+
+
+# CONTENT_COLUMNS as stored in canon_media
+STORED_CONTENT_COLUMNS = [
+    refs_column(c) if c in HTML_COLUMNS else c for c in CONTENT_COLUMNS
+]
+
+
+def make_content_hash(values: dict) -> str:
+    return hashlib.sha1(
+        json.dumps([values[c] for c in CONTENT_COLUMNS]).encode()
+    ).hexdigest()
+
+
+class CanonMediaEntry(MediaColumns, Base):
+    __tablename__ = "canon_media"
+
+    __table_args__ = (
+        Index(
+            "ix_canon_media_content_type_watched_id", "content_type", "watched", "id"
+        ),
+        Index("ix_canon_media_watched_id", "watched", "id"),
+        Index("ux_canon_media_natural_key", "natural_key", unique=True),
+        Index("ix_canon_media_year_sort_id", "year_sort", "id"),
+    )
+
+
+class HtmlFragment(Base):
+    # Dictionary of the HTML pieces (links, citations, text runs) that the
+    # *_html cells are made of; each distinct piece is stored once. Ids are
+    # never reused, so cached fragments can't go stale.
+    __tablename__ = "html_fragments"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    # fragments.fragment_digest of html, for interning without indexing the
+    # text itself
+    digest = Column(Integer, nullable=False)
+    html = Column(String, nullable=False)
+
+    __table_args__ = (
+        Index("ux_html_fragments_digest", "digest", unique=True),
+        {"sqlite_autoincrement": True},
+    )
+
+
+class RemovedMediaEntry(MediaColumns, Base):
+    # Entries soft-deleted by the importer after disappearing upstream. They
+    # keep their id, watched flag and season/episode, and move back into
+    # canon_media if they reappear.
+    __tablename__ = "canon_media_removed"
+
+    removed_at = Column(DateTime, nullable=False, server_default=func.now())
+
+    __table_args__ = (
+        Index("ux_canon_media_removed_natural_key", "natural_key", unique=True),
+    )
+
+
+# External-content FTS5 index over the searchable text columns, kept in step
+# with canon_media by triggers. Watched toggles never touch it.
+canon_media_fts = table("canon_media_fts", column("rowid"))
+FTS_SCHEMA = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS canon_media_fts USING fts5("
+    "title, episode_title, content_type, content='canon_media', "
+    "content_rowid='id', tokenize='unicode61 remove_diacritics 2', "
+    "prefix='2 3')",
+    "CREATE TRIGGER IF NOT EXISTS canon_media_fts_ai AFTER INSERT ON canon_media "
+    "BEGIN INSERT INTO canon_media_fts (rowid, title, episode_title, content_type) "
+    "VALUES (new.id, new.title, new.episode_title, new.content_type); END",
+    "CREATE TRIGGER IF NOT EXISTS canon_media_fts_ad AFTER DELETE ON canon_media "
+    "BEGIN INSERT INTO canon_media_fts "
+    "(canon_media_fts, rowid, title, episode_title, content_type) "
+    "VALUES ('delete', old.id, old.title, old.episode_title, old.content_type); "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS canon_media_fts_au "
+    "AFTER UPDATE OF title, episode_title, content_type ON canon_media "
+    "BEGIN INSERT INTO canon_media_fts "
+    "(canon_media_fts, rowid, title, episode_title, content_type) "
+    "VALUES ('delete', old.id, old.title, old.episode_title, old.content_type); "
+    "INSERT INTO canon_media_fts (rowid, title, episode_title, content_type) "
+    "VALUES (new.id, new.title, new.episode_title, new.content_type); END",
+]
+for _statement in FTS_SCHEMA:
+    event.listen(CanonMediaEntry.__table__, "after_create", DDL(_statement))
+
+
+class WatchState(Base):
+    # Per-user progress: a row means user_id has watched media_id. The shared
+    # canon_media rows are never copied per user, and the table is clustered
+    # on its primary key so user-scoped lookups never leave the index.
+    __tablename__ = "watch_state"
+
+    user_id = Column(String(64), primary_key=True)
+    # Foreign key enforcement is deliberately left off: soft-deleted entries
+    # move to canon_media_removed with their id, and users' progress has to
+    # survive until they come back. Snapshot imports drop progress for ids
+    # that are gone themselves. (Databases created earlier still declare ON
+    # DELETE CASCADE here, which never runs.)
+    media_id = Column(Integer, ForeignKey("canon_media.id"), primary_key=True)
+    watched_at = Column(DateTime, nullable=False, server_default=func.now())
+
+    __table_args__ = {"sqlite_with_rowid": False}
+
+
+# Watched/total counters per bucket of each STATS_DIMENSIONS entry, kept
+# current by triggers on canon_media inside the writing transaction. Like the
+# FTS index it is created with canon_media (or by its migration), since the
+# triggers need columns added by earlier migrations.
+media_stats = table(
+    "media_stats",
+    column("dimension"),
+    column("bucket"),
+    column("total"),
+    column("watched"),
+)
+# dimension -> (bucket expression, row filter) over a canon_media row aliased
+# as {row}; rows failing the filter are not counted for that dimension.
+STATS_DIMENSIONS = {
+    "content_type": ("coalesce({row}.content_type, '')", "1"),
+    "era": (
+        "CASE WHEN {row}.year_sort IS NULL THEN 'unknown' "
+        "WHEN {row}.year_sort < 0 THEN 'BBY' ELSE 'ABY' END",
+        "1",
+    ),
+    # Per series: a TV entry's title is its show, e.g. "Star Wars Rebels S02"
+    "season": (
+        "{row}.title || ' ' || {row}.season",
+        "{row}.content_type = 'TV' AND {row}.season != ''",
+    ),
+}
+
+
+def _stats_delta(row: str, sign: str) -> str:
+    return " ".join(
+        "INSERT INTO media_stats (dimension, bucket, total, watched) "
+        f"SELECT '{name}', {bucket.format(row=row)}, {sign}1, "
+        f"{sign}coalesce({row}.watched, 0) WHERE {where.format(row=row)} "
+        "ON CONFLICT (dimension, bucket) DO UPDATE SET "
+        "total = total + excluded.total, watched = watched + excluded.watched;"
+        for name, (bucket, where) in STATS_DIMENSIONS.items()
+    )
+
+
+STATS_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS media_stats (dimension VARCHAR(16) NOT NULL, "
+    "bucket VARCHAR(64) NOT NULL, total INTEGER NOT NULL DEFAULT 0, "
+    "watched INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (dimension, bucket)) "
+    "WITHOUT ROWID",
+    "CREATE TRIGGER IF NOT EXISTS media_stats_ai AFTER INSERT ON canon_media "
+    f"BEGIN {_stats_delta('new', '')} END",
+    "CREATE TRIGGER IF NOT EXISTS media_stats_ad AFTER DELETE ON canon_media "
+    f"BEGIN {_stats_delta('old', '-')} END",
+    "CREATE TRIGGER IF NOT EXISTS media_stats_au "
+    "AFTER UPDATE OF watched, content_type, year_sort, season, title "
+    "ON canon_media WHEN old.watched IS NOT new.watched "
+    "OR old.content_type IS NOT new.content_type "
+    "OR old.year_sort IS NOT new.year_sort OR old.season IS NOT new.season "
+    "OR old.title IS NOT new.title "
+    f"BEGIN {_stats_delta('old', '-')} {_stats_delta('new', '')} END",
+]
+for _statement in STATS_SCHEMA:
+    event.listen(CanonMediaEntry.__table__, "after_create", DDL(_statement))
+# Full recompute from canon_media, for migrations and verification
+STATS_RECOMPUTE = " UNION ALL ".join(
+    f"SELECT '{name}' AS dimension, {bucket.format(row='m')} AS bucket, "
+    "count(*) AS total, coalesce(sum(m.watched), 0) AS watched "
+    f"FROM canon_media AS m WHERE {where.format(row='m')} GROUP BY 2"
+    for name, (bucket, where) in STATS_DIMENSIONS.items()
+)
+
+
+# One-row table of change counters, bumped by triggers inside every writing
+# transaction. The importer, the scrapers and other server workers write from
+# their own processes, so HTTP validators and the in-memory catalogue read
+# these instead of tracking writes themselves. media_version counts changes to
+# canon_media other than watched, watched_version counts watched updates and
+# version counts everything, per-user progress included. modified_at is in
+# whole seconds; epoch is random per database so a recreated file can't
+# repeat old ETags.
+data_version = table(
+    "data_version",
+    column("epoch"),
+    column("version"),
+    column("media_version"),
+    column("watched_version"),
+    column("modified_at"),
+)
+# Unix time in whole seconds (without strftime's %s, which DDL would take for
+# a format placeholder)
+_NOW = "CAST((julianday('now') - 2440587.5) * 86400 AS INTEGER)"
+
+
+def _bump_version(*counters: str) -> str:
+    assignments = ", ".join(f"{c} = {c} + 1" for c in ("version", *counters))
+    return (
+        f"UPDATE data_version SET {assignments}, "
+        f"modified_at = max(modified_at, {_NOW});"
+    )
+
+
+_DATA_VERSION_TABLE = [
+    "CREATE TABLE IF NOT EXISTS data_version (id INTEGER PRIMARY KEY "
+    "CHECK (id = 1), epoch VARCHAR(16) NOT NULL, "
+    "version INTEGER NOT NULL DEFAULT 0, "
+    "media_version INTEGER NOT NULL DEFAULT 0, "
+    "watched_version INTEGER NOT NULL DEFAULT 0, modified_at INTEGER NOT NULL)",
+    "INSERT OR IGNORE INTO data_version (id, epoch, modified_at) "
+    f"VALUES (1, lower(hex(randomblob(8))), {_NOW})",
+]
+# Every canon_media column but watched
+_MEDIA_COLUMNS = ", ".join(
+    c.name for c in CanonMediaEntry.__table__.columns if c.name != "watched"
+)
+MEDIA_VERSION_SCHEMA = [
+    *_DATA_VERSION_TABLE,
+    "CREATE TRIGGER IF NOT EXISTS data_version_media_ai "
+    f"AFTER INSERT ON canon_media BEGIN {_bump_version('media_version')} END",
+    "CREATE TRIGGER IF NOT EXISTS data_version_media_ad "
+    f"AFTER DELETE ON canon_media BEGIN {_bump_version('media_version')} END",
+    "CREATE TRIGGER IF NOT EXISTS data_version_media_au "
+    f"AFTER UPDATE OF {_MEDIA_COLUMNS} ON canon_media "
+    f"BEGIN {_bump_version('media_version')} END",
+    # Once per updated row, changed or not, so a writer can tell its own
+    # updates apart from anyone else's
+    "CREATE TRIGGER IF NOT EXISTS data_version_watched_au "
+    "AFTER UPDATE OF watched ON canon_media "
+    f"BEGIN {_bump_version('watched_version')} END",
+]
+for _statement in MEDIA_VERSION_SCHEMA:
+    event.listen(CanonMediaEntry.__table__, "after_create", DDL(_statement))
+WATCH_STATE_VERSION_SCHEMA = [
+    *_DATA_VERSION_TABLE,
+    *(
+        f"CREATE TRIGGER IF NOT EXISTS data_version_watch_state_{name} "
+        f"AFTER {event_name} ON watch_state BEGIN {_bump_version()} END"
+        for name, event_name in (("ai", "INSERT"), ("ad", "DELETE"), ("au", "UPDATE"))
+    ),
+]
+for _statement in WATCH_STATE_VERSION_SCHEMA:
+    event.listen(WatchState.__table__, "after_create", DDL(_statement))
 
 
 class CanonMediaEntrySchema(BaseModel):
     id: int
     year: Optional[str]
-    year_html: Optional[str]
+    year_html: Optional[str] = None
     content_type: Optional[str]
-    content_type_html: Optional[str]
+    content_type_html: Optional[str] = None
     title: str
     episode_title: Optional[str]
     episode_url: Optional[str]
-    title_html: Optional[str]
+    title_html: Optional[str] = None
     released: Optional[str]
-    released_html: Optional[str]
+    released_html: Optional[str] = None
     watched: bool
     season: str = ""
     episode: str = ""
+    year_sort: Optional[int] = None
 
     model_config = {"from_attributes": True}
+
+
+UserId = Annotated[str, Field(min_length=1, max_length=64)]
+
+
+class MediaFilter(BaseModel):
+    content_type: Optional[List[str]] = None
+    # Resolved against watch_state when user_id is set, otherwise against the
+    # shared canon_media.watched column
+    watched: Optional[bool] = None
+    user_id: Optional[UserId] = None
+    # Keyset cursor: id_gt is the exclusive lower bound (also fed by ``after``),
+    # id_lt the exclusive upper bound, and limit the page size.
+    id_gt: Optional[int] = None
+    id_lt: Optional[int] = None
+    limit: Optional[int] = None
+    # Inclusive bounds on year_sort
+    year_from: Optional[int] = None
+    year_to: Optional[int] = None
+    # Full-text search over title, episode_title and content_type; every
+    # word is matched as a prefix.
+    q: Optional[str] = None
+    # "year" orders by (year_sort, id) and pages with the (after_year,
+    # after_id) cursor; "id" pages through id_gt; "rank" orders search
+    # matches best first and pages by offset.
+    order: Literal["id", "year", "rank"] = "id"
+    after_year: Optional[int] = None
+    after_id: Optional[int] = None
+    offset: Optional[int] = None
+    # Leave the *_html cells unresolved (None) for plain-text rendering
+    include_html: bool = True
+
+
+class BulkWatchedUpdate(BaseModel):
+    # Entries matching every given selector are updated in one statement
+    watched: bool
+    user_id: Optional[UserId] = None
+    # Empty lists are rejected rather than read as "no filter"
+    ids: Optional[List[int]] = Field(None, min_length=1, max_length=10000)
+    id_gt: Optional[int] = None
+    id_lt: Optional[int] = None
+    content_type: Optional[List[str]] = Field(None, min_length=1)
+    title: Optional[str] = Field(
+        None, description="Series title as stored, e.g. 'Star Wars Rebels'"
+    )
+    season: Optional[str] = Field(None, description="Season as stored, e.g. 'S01'")
+
+    @model_validator(mode="after")
+    def require_selector(self):
+        if not any(
+            value is not None
+            for value in (
+                self.ids,
+                self.id_gt,
+                self.id_lt,
+                self.content_type,
+                self.title,
+                self.season,
+            )
+        ):
+            raise ValueError(
+                "Select entries by ids, id range, content_type, title or season"
+            )
+        # Every show numbers its seasons from S01
+        if self.season is not None and self.title is None:
+            raise ValueError("season needs the series title")
+        return self
+
+
+class StatsBucket(BaseModel):
+    bucket: str
+    watched: int
+    total: int
+
+
+class BulkWatchedResult(BaseModel):
+    watched: bool
+    updated: int
+    ids: List[int]
@@ -0,0 +1,102 @@
+import hashlib
+import json
+import os
+import time
+from typing import Dict, NamedTuple, Optional
+
+
+class CachedPage(NamedTuple):
+    sha256: str
+    etag: Optional[str]
+    last_modified: Optional[str]
+    season: str
+    episode: str
+    accessed: float
+
+
+class PageCache:
+    # On-disk cache of fetched pages. Bodies are stored once per content hash
+    # under objects/, and index.json maps each URL to its body, its HTTP
+    # validators and the season/episode already extracted from it, so a 304
+    # needs neither the body nor a re-parse. Least recently used pages are
+    # evicted once the bodies outgrow max_bytes.
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._objects = os.path.join(directory, "objects")
+        self._index_path = os.path.join(directory, "index.json")
+        os.makedirs(self._objects, exist_ok=True)
+        self._entries: Dict[str, CachedPage] = {}
+        if os.path.exists(self._index_path):
+            with open(self._index_path, encoding="utf-8") as f:
+                for url, entry in json.load(f).items():
+                    if os.path.exists(self._object_path(entry["sha256"])):
+                        self._entries[url] = CachedPage(**entry)
+
+    def _object_path(self, sha256: str) -> str:
+        return os.path.join(self._objects, f"{sha256}.html")
+
+    def get(self, url: str) -> Optional[CachedPage]:
+        entry = self._entries.get(url)
+        if entry is not None:
+            entry = self._entries[url] = entry._replace(accessed=time.time())
+        return entry
+
+    def conditional_headers(self, entry: Optional[CachedPage]) -> Dict[str, str]:
+        headers = {}
+        if entry is not None:
+            if entry.etag:
+                headers["If-None-Match"] = entry.etag
+            if entry.last_modified:
+                headers["If-Modified-Since"] = entry.last_modified
+        return headers
+
+    def read(self, entry: CachedPage) -> str:
+        with open(self._object_path(entry.sha256), encoding="utf-8") as f:
+            return f.read()
+
+    def put(self, url, body, etag, last_modified, season, episode):
+        sha256 = hashlib.sha256(body.encode()).hexdigest()
+        path = self._object_path(sha256)
+        if not os.path.exists(path):
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(body)
+            os.replace(tmp_path, path)
+        self._entries[url] = CachedPage(
+            sha256, etag, last_modified, season, episode, time.time()
+        )
+
+    def urls(self):
+        return list(self._entries)
+
+    def evict(self):
+        sizes = {
+            e.sha256: os.path.getsize(self._object_path(e.sha256))
+            for e in self._entries.values()
+        }
+        total = sum(sizes.values())
+        refs: Dict[str, int] = {}
+        for e in self._entries.values():
+            refs[e.sha256] = refs.get(e.sha256, 0) + 1
+        by_age = sorted(self._entries.items(), key=lambda item: item[1].accessed)
+        for url, entry in by_age:
+            if total <= self.max_bytes:
+                break
+            del self._entries[url]
+            refs[entry.sha256] -= 1
+            if not refs[entry.sha256]:
+                os.remove(self._object_path(entry.sha256))
+                total -= sizes[entry.sha256]
+        # Bodies left behind by an interrupted run are not in the index
+        for name in os.listdir(self._objects):
+            if name.removesuffix(".html") not in sizes:
+                os.remove(os.path.join(self._objects, name))
+
+    def save(self):
+        self.evict()
+        tmp_path = f"{self._index_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({url: e._asdict() for url, e in self._entries.items()}, f)
+        os.replace(tmp_path, self._index_path)
@@ -0,0 +1,277 @@
+import re
+from typing import AsyncIterator, Dict, List, Optional
+
+from sqlalchemy import (
+    and_,
+    delete,
+    func,
+    literal,
+    literal_column,
+    select,
+    text,
+    true,
+    tuple_,
+    update,
+)
+from sqlalchemy.dialects.sqlite import insert
+
+from catalogue import catalogue
+from db import AsyncSessionLocal
+from fragments import fragment_cache
+from metrics import span
+from models import (
+    STATS_DIMENSIONS,
+    STATS_RECOMPUTE,
+    BulkWatchedUpdate,
+    CanonMediaEntry,
+    CanonMediaEntrySchema,
+    MediaFilter,
+    StatsBucket,
+    WatchState,
+    canon_media_fts,
+    media_stats,
+)
+
+STREAM_BATCH_SIZE = 500
+# bm25 column weights for title, episode_title and content_type
+SEARCH_WEIGHTS = (10.0, 5.0, 1.0)
+SEARCH_TERM_RE = re.compile(r"\w+")
+
+
+def match_expression(q: Optional[str]) -> Optional[str]:
+    # Each word becomes a quoted prefix term, so user input can never be
+    # parsed as FTS5 query syntax.
+    terms = SEARCH_TERM_RE.findall(q or "")
+    if not terms:
+        return None
+    return " ".join(f'"{term}"*' for term in terms)
+
+
+def search_query(expression: str):
+    fts = literal_column("canon_media_fts")
+    return (
+        select(
+            canon_media_fts.c.rowid.label("id"),
+            func.bm25(fts, *SEARCH_WEIGHTS).label("score"),
+        )
+        .where(fts.op("MATCH")(expression))
+        .subquery()
+    )
+
+
+def media_query(filters: MediaFilter):
+    # Each filter maps onto the leading columns of the canon_media indexes
+    # (content_type, watched, id) so SQLite never has to scan the whole table.
+    stmt = select(CanonMediaEntry)
+    expression = match_expression(filters.q)
+    matches = search_query(expression) if expression else None
+    if matches is not None:
+        stmt = stmt.join(matches, matches.c.id == CanonMediaEntry.id)
+    if filters.user_id is not None:
+        # One primary-key probe into watch_state per entry; unwatched is the
+        # anti-join (no matching row).
+        stmt = stmt.outerjoin(
+            WatchState,
+            and_(
+                WatchState.user_id == filters.user_id,
+                WatchState.media_id == CanonMediaEntry.id,
+            ),
+        ).add_columns(WatchState.media_id.is_not(None).label("user_watched"))
+        if filters.watched is not None:
+            stmt = stmt.where(
+                WatchState.media_id.is_not(None)
+                if filters.watched
+                else WatchState.media_id.is_(None)
+            )
+    elif filters.watched is not None:
+        stmt = stmt.where(CanonMediaEntry.watched == filters.watched)
+    if filters.content_type:
+        stmt = stmt.where(CanonMediaEntry.content_type.in_(filters.content_type))
+    if filters.id_gt is not None:
+        stmt = stmt.where(CanonMediaEntry.id > filters.id_gt)
+    if filters.id_lt is not None:
+        stmt = stmt.where(CanonMediaEntry.id < filters.id_lt)
+    if filters.year_from is not None:
+        stmt = stmt.where(CanonMediaEntry.year_sort >= filters.year_from)
+    if filters.year_to is not None:
+        stmt = stmt.where(CanonMediaEntry.year_sort <= filters.year_to)
+    if filters.order == "year":
+        # Walks ix_canon_media_year_sort_id; rows without a year are skipped
+        stmt = stmt.where(CanonMediaEntry.year_sort.is_not(None))
+        if filters.after_year is not None and filters.after_id is not None:
+            stmt = stmt.where(
+                tuple_(CanonMediaEntry.year_sort, CanonMediaEntry.id)
+                > tuple_(filters.after_year, filters.after_id)
+            )
+        stmt = stmt.order_by(CanonMediaEntry.year_sort, CanonMediaEntry.id)
+    elif filters.order == "rank" and matches is not None:
+        stmt = stmt.order_by(matches.c.score, CanonMediaEntry.id)
+    else:
+        stmt = stmt.order_by(CanonMediaEntry.id)
+    if filters.limit is not None:
+        stmt = stmt.limit(filters.limit)
+    if filters.offset:
+        stmt = stmt.offset(filters.offset)
+    return stmt
+
+
+def _select_entries(stmt, selection: BulkWatchedUpdate):
+    if selection.ids is not None:
+        stmt = stmt.where(CanonMediaEntry.id.in_(selection.ids))
+    if selection.id_gt is not None:
+        stmt = stmt.where(CanonMediaEntry.id > selection.id_gt)
+    if selection.id_lt is not None:
+        stmt = stmt.where(CanonMediaEntry.id < selection.id_lt)
+    if selection.content_type is not None:
+        stmt = stmt.where(CanonMediaEntry.content_type.in_(selection.content_type))
+    if selection.title is not None:
+        stmt = stmt.where(CanonMediaEntry.title == selection.title)
+    if selection.season is not None:
+        stmt = stmt.where(CanonMediaEntry.season == selection.season)
+    return stmt
+
+
+def bulk_watched_query(selection: BulkWatchedUpdate):
+    stmt = update(CanonMediaEntry).values(watched=selection.watched)
+    return _select_entries(stmt, selection).returning(CanonMediaEntry.id)
+
+
+def selected_ids_query(selection: BulkWatchedUpdate):
+    return _select_entries(select(CanonMediaEntry.id), selection)
+
+
+def user_watched_query(selection: BulkWatchedUpdate):
+    # Applies selection to selection.user_id's watch_state in one statement;
+    # rows already in the requested state are left alone, so watched_at keeps
+    # the time an entry was first marked.
+    if selection.watched:
+        # SQLite needs a WHERE before ON CONFLICT to parse INSERT ... SELECT
+        # as an upsert, even when the selection adds none
+        rows = _select_entries(
+            select(literal(selection.user_id), CanonMediaEntry.id).where(true()),
+            selection,
+        )
+        return (
+            insert(WatchState)
+            .from_select([WatchState.user_id, WatchState.media_id], rows)
+            .on_conflict_do_nothing()
+        )
+    return delete(WatchState).where(
+        WatchState.user_id == selection.user_id,
+        WatchState.media_id.in_(selected_ids_query(selection).scalar_subquery()),
+    )
+
+
+def content_types_query():
+    return (
+        select(CanonMediaEntry.content_type)
+        .where(
+            CanonMediaEntry.content_type.is_not(None),
+            CanonMediaEntry.content_type != "",
+        )
+        .distinct()
+        .order_by(CanonMediaEntry.content_type)
+    )
+
+
+async def _validate_rows(
+    session, filters: MediaFilter, rows
+) -> List[CanonMediaEntrySchema]:
+    rows = list(rows)
+    entries = [row[0] for row in rows]
+    if filters.include_html:
+        cells = await fragment_cache.resolve(session, entries)
+    else:
+        cells = [{}] * len(entries)
+    with span("validate"):
+        if filters.user_id is None:
+            return [
+                CanonMediaEntrySchema.model_validate(m).model_copy(update=html)
+                for m, html in zip(entries, cells)
+            ]
+        return [
+            CanonMediaEntrySchema.model_validate(m).model_copy(
+                update={**html, "watched": watched}
+            )
+            for (m, watched), html in zip(rows, cells)
+        ]
+
+
+async def fetch_media(filters: MediaFilter) -> List[CanonMediaEntrySchema]:
+    if catalogue.supports(filters):
+        return await catalogue.select(filters)
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(media_query(filters))
+        # Only the rows that survived the WHERE clause are validated
+        return await _validate_rows(session, filters, result)
+
+
+async def fetch_media_page(filters: MediaFilter):
+    # Fetch one row past the page to learn whether a next page exists
+    rows = await fetch_media(filters.model_copy(update={"limit": filters.limit + 1}))
+    if len(rows) > filters.limit:
+        rows = rows[: filters.limit]
+        last = rows[-1]
+        if filters.order == "year":
+            return rows, f"{last.year_sort}:{last.id}"
+        if filters.order == "rank":
+            return rows, str((filters.offset or 0) + filters.limit)
+        return rows, str(last.id)
+    return rows, None
+
+
+async def iter_media_batches(
+    filters: MediaFilter,
+) -> AsyncIterator[List[CanonMediaEntrySchema]]:
+    if catalogue.supports(filters):
+        async for batch in catalogue.iter_batches(filters, STREAM_BATCH_SIZE):
+            yield batch
+        return
+    # Rows are pulled from a server-side cursor in batches, so the full result
+    # set is never materialised.
+    stmt = media_query(filters).execution_options(yield_per=STREAM_BATCH_SIZE)
+    async with AsyncSessionLocal() as session:
+        result = await session.stream(stmt)
+        async for batch in result.partitions():
+            yield await _validate_rows(session, filters, batch)
+
+
+async def stream_media(filters: MediaFilter) -> AsyncIterator[str]:
+    async for batch in iter_media_batches(filters):
+        yield "".join(m.model_dump_json() + "\n" for m in batch)
+
+
+def stats_query(recompute: bool = False):
+    if recompute:
+        return text(STATS_RECOMPUTE + " ORDER BY dimension, bucket")
+    return (
+        select(
+            media_stats.c.dimension,
+            media_stats.c.bucket,
+            media_stats.c.total,
+            media_stats.c.watched,
+        )
+        .where(media_stats.c.total > 0)
+        .order_by(media_stats.c.dimension, media_stats.c.bucket)
+    )
+
+
+async def fetch_stats(recompute: bool = False) -> Dict[str, List[StatsBucket]]:
+    # recompute aggregates canon_media from scratch instead of reading the
+    # trigger-maintained counters, to check them against each other
+    stats: Dict[str, List[StatsBucket]] = {name: [] for name in STATS_DIMENSIONS}
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(stats_query(recompute))
+        for dimension, bucket, total, watched in result:
+            stats[dimension].append(
+                StatsBucket(bucket=bucket, watched=watched, total=total)
+            )
+    return stats
+
+
+async def fetch_content_types() -> List[str]:
+    if catalogue.loaded:
+        return catalogue.content_types
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(content_types_query())
+        return list(result.scalars())
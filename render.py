@@ -0,0 +1,147 @@
+import html
+from typing import AsyncIterator, Iterable, List
+
+from metrics import span
+
+# Templates for /media/table. They are formatted once per page (form) or once
+# per row (ROW_TEMPLATE) and the page is streamed out in row chunks, so no
+# single string ever holds the whole table.
+FORM_HEAD = """
+    <form method='get'>
+        <label>Filter by type:</label>
+        <select name='content_type' multiple size='10' onchange='if([...this.options].every(opt=>!opt.selected)){this.form.removeAttribute("action");this.form.submit();}else{this.form.submit();}'>
+    """
+OPTION_TEMPLATE = "<option value='{value}' {selected}>{value}</option>"
+# Keeps plain mode on when the filters are resubmitted
+PLAIN_INPUT = "<input type='hidden' name='plain' value='true'>"
+FORM_TAIL_TEMPLATE = """
+        </select>
+        <label>Watched:</label>
+        <select name='watched' onchange='if(this.value==""){{this.form.removeAttribute("action");this.form.submit();}}else{{this.form.submit();}}'>
+            <option value=''>All</option>
+            <option value='true' {watched_selected}>Watched</option>
+            <option value='false' {unwatched_selected}>Unwatched</option>
+        </select>
+        <label>ID greater than:</label>
+        <input type='number' name='id_gt' value='{id_gt}' onchange='if(this.value==""){{this.form.removeAttribute("action");this.form.submit();}}else{{this.form.submit();}}'>
+        <label>ID less than:</label>
+        <input type='number' name='id_lt' value='{id_lt}' onchange='if(this.value==""){{this.form.removeAttribute("action");this.form.submit();}}else{{this.form.submit();}}'>
+        <label>Search:</label>
+        <input type='search' name='q' value='{q}' onchange='this.form.submit();'>
+        {plain_input}
+    </form>
+    """
+TABLE_HEAD = """<table border='1'>
+        <tr><th>ID</th><th>Year</th><th>Type</th><th>Title</th><th>Season</th><th>Episode</th><th>Released</th><th>Watched</th><th>Action</th></tr>
+    """
+ROW_TEMPLATE = (
+    "<tr><td>{id}</td><td>{year}</td><td>{content_type}</td>"
+    "<td>{title}{episode_title}</td><td>{season}</td><td>{episode}</td>"
+    "<td>{released}</td><td>{watched}</td>"
+    "<td><form method='post' action='/media/{id}/watched{action_query}'>"
+    "<input type='hidden' name='watched' value='{toggle}'>"
+    "<button type='submit'>{label}</button></form></td></tr>"
+)
+# Toggles a row's watched state in place instead of reloading the whole table
+TOGGLE_SCRIPT = """
+    <script>
+    document.addEventListener("submit", async (event) => {
+        const form = event.target;
+        if (form.method !== "post" || !form.action.includes("/watched")) return;
+        event.preventDefault();
+        const response = await fetch(form.action, {
+            method: "POST",
+            body: new FormData(form),
+            headers: {Accept: "application/json"},
+        });
+        if (!response.ok) return form.submit();
+        const entry = await response.json();
+        form.closest("tr").cells[7].textContent = entry.watched ? "Yes" : "No";
+        form.elements.watched.value = String(!entry.watched);
+        form.querySelector("button").textContent = entry.watched
+            ? "Mark Unwatched"
+            : "Mark Watched";
+    });
+    </script>
+    """
+TABLE_TAIL = "</table>" + TOGGLE_SCRIPT
+
+_format_option = OPTION_TEMPLATE.format
+_format_row = ROW_TEMPLATE.format
+
+
+def render_filter_form(
+    types, selected_types, watched, id_gt, id_lt, q=None, plain=False
+) -> str:
+    options = "".join(
+        _format_option(value=t, selected="selected" if t in selected_types else "")
+        for t in types
+    )
+    return (
+        FORM_HEAD
+        + options
+        + FORM_TAIL_TEMPLATE.format(
+            watched_selected="selected" if watched is True else "",
+            unwatched_selected="selected" if watched is False else "",
+            id_gt=id_gt if id_gt is not None else "",
+            id_lt=id_lt if id_lt is not None else "",
+            q=html.escape(q or "", quote=True),
+            plain_input=PLAIN_INPUT if plain else "",
+        )
+    )
+
+
+def _html_cells(m) -> dict:
+    return dict(
+        year=m.year_html if m.year_html else m.year,
+        content_type=m.content_type_html if m.content_type_html else m.content_type,
+        title=m.title_html if m.title_html else m.title,
+        episode_title=(
+            f" -- {m.episode_title}" if not m.title_html and m.episode_title else ""
+        ),
+        released=m.released_html if m.released_html else m.released,
+    )
+
+
+def _plain_cells(m) -> dict:
+    # Text columns only: no wiki links or citations
+    return dict(
+        year=html.escape(m.year or ""),
+        content_type=html.escape(m.content_type or ""),
+        title=html.escape(m.title),
+        episode_title=(f" — {html.escape(m.episode_title)}" if m.episode_title else ""),
+        released=html.escape(m.released or ""),
+    )
+
+
+def render_rows(rows: Iterable, action_query: str = "", plain: bool = False) -> str:
+    cells = _plain_cells if plain else _html_cells
+    return "".join(
+        _format_row(
+            id=m.id,
+            **cells(m),
+            season=m.season,
+            episode=m.episode,
+            watched="Yes" if m.watched else "No",
+            action_query=action_query,
+            toggle=str(not m.watched).lower(),
+            label="Mark Unwatched" if m.watched else "Mark Watched",
+        )
+        for m in rows
+    )
+
+
+async def render_media_table(
+    form_html: str,
+    batches: AsyncIterator[List],
+    query_string: str = "",
+    plain: bool = False,
+) -> AsyncIterator[str]:
+    # The filter form goes out before the first row is read from the database
+    yield form_html + TABLE_HEAD
+    action_query = f"?{query_string}" if query_string else ""
+    async for batch in batches:
+        with span("render"):
+            chunk = render_rows(batch, action_query, plain)
+        yield chunk
+    yield TABLE_TAIL
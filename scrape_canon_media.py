@@ -1,175 +1,207 @@
+import argparse
 import asyncio
 import json
+import time
+from typing import Dict, List, NamedTuple, Optional
 
-from bs4 import BeautifulSoup, Tag
-from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.future import select
+from sqlalchemy import delete, func, select
+from sqlalchemy.dialects.sqlite import insert
 
-from db import AsyncSessionLocal, engine
-from models import Base, CanonMediaEntry
+from chronology import year_sort_keys
+from db import engine
+from fragments import batches, intern_fragments, normalize_row, prune_fragments
+from media_parsers import PARSERS, ParsedRow
+from migrations import migrate
+from models import (
+    CONTENT_COLUMNS,
+    STORED_CONTENT_COLUMNS,
+    CanonMediaEntry,
+    RemovedMediaEntry,
+    make_content_hash,
+)
 
+UPSERT_BATCH_SIZE = 1000
+# Identifies an entry in the diff report
+REPORT_COLUMNS = ["year", "content_type", "title", "episode_title", "released"]
 
-async def scrape_and_store():
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
 
-    with open("media_table.html") as html_file:
-        soup = BeautifulSoup(html_file, "html.parser")
+class ImportStats(NamedTuple):
+    parsed: int
+    inserted: int
+    updated: int
+    unchanged: int
+    removed: int
+    restored: int
+    seconds: float
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.parsed / self.seconds if self.seconds else 0.0
+
+
+class ImportDiff(NamedTuple):
+    inserted: List[dict]
+    updated: List[dict]
+    removed: List[dict]
+    restored: List[dict]
+
+
+async def _select_by_keys(conn, table, columns, keys: list) -> Dict[str, dict]:
+    found = {}
+    for batch in batches(keys):
+        result = await conn.execute(
+            select(table.c.natural_key, *[table.c[c] for c in columns]).where(
+                table.c.natural_key.in_(batch)
+            )
+        )
+        found.update((row.natural_key, row._asdict()) for row in result)
+    return found
+
 
-    entries = []
-    entry_id = 0
-    async with AsyncSessionLocal() as session:
-        for table in soup.find_all("table"):
-            if not isinstance(table, Tag):
+async def _move_rows(conn, source, target, keys: list, **extra):
+    # Moves whole rows (id and watched flag included) between canon_media and
+    # its archive; the canon_media triggers keep FTS and /stats in step.
+    columns = [c.name for c in CanonMediaEntry.__table__.columns]
+    for batch in batches(keys):
+        rows = select(*[source.c[c] for c in columns], *extra.values()).where(
+            source.c.natural_key.in_(batch)
+        )
+        await conn.execute(insert(target).from_select([*columns, *extra], rows))
+        await conn.execute(delete(source).where(source.c.natural_key.in_(batch)))
+
+
+async def upsert_rows(rows: List[ParsedRow], soft_delete: bool = False):
+    # Later duplicates of a natural key win, as they did with per-row updates.
+    # year_sort depends on the rows around it, so it is derived before dedup.
+    by_key: Dict[str, dict] = {}
+    for row, year_sort in zip(rows, year_sort_keys(row.year for row in rows)):
+        values = normalize_row({**row._asdict(), "year_sort": year_sort})
+        values["content_hash"] = make_content_hash(values)
+        by_key[row.natural_key] = values
+    table = CanonMediaEntry.__table__
+    archive = RemovedMediaEntry.__table__
+    async with engine.begin() as conn:
+        # Only keys and hashes are read; unchanged rows are never written
+        result = await conn.execute(select(table.c.natural_key, table.c.content_hash))
+        existing = dict(result.all())
+        result = await conn.execute(select(archive.c.natural_key))
+        archived = set(result.scalars())
+        restored = [k for k in by_key if k not in existing and k in archived]
+        removed = [k for k in existing if k not in by_key]
+        # New rows get ids past the archive too, so a restored entry (and any
+        # watch_state rows pointing at it) never collides with a newer one
+        result = await conn.execute(
+            select(func.max(table.c.id)).union_all(select(func.max(archive.c.id)))
+        )
+        next_id = max((i for i in result.scalars() if i is not None), default=0) + 1
+        new_rows, changed_rows = [], []
+        inserted, updated = [], []
+        for key, values in by_key.items():
+            if key in existing:
+                if existing[key] == values["content_hash"]:
+                    continue
+                updated.append(key)
+            elif key not in archived:
+                inserted.append(key)
+                new_rows.append({"id": next_id, "natural_key": key, **values})
+                next_id += 1
                 continue
-            headers = [
-                th.get_text(strip=True)
-                for th in table.find_all("th")
-                if isinstance(th, Tag)
-            ]
-            if "Year" in headers and "Title" in headers and "Released" in headers:
-                for row in table.find_all("tr")[1:]:
-                    if not isinstance(row, Tag):
-                        continue
-                    cells = [
-                        cell
-                        for cell in row.find_all(["td", "th"])
-                        if isinstance(cell, Tag)
-                    ]
-                    if len(cells) >= 4:
-                        year_cell = cells[0]
-                        type_cell = cells[1]
-                        title_cell = cells[2]
-                        released_cell = cells[3]
-
-                        # Prepend local hrefs in all cells
-                        for cell in [year_cell, type_cell, title_cell, released_cell]:
-                            if cell:
-                                for a in cell.find_all("a", href=True):
-                                    if isinstance(a, Tag):
-                                        href = a.get("href")
-                                        if (
-                                            isinstance(href, str)
-                                            and href.startswith("/")
-                                            and not href.startswith("//")
-                                        ):
-                                            a.attrs["href"] = (
-                                                f"https://starwars.fandom.com{href}"
-                                            )
-
-                        # For year (cell 0)
-                        year = year_cell.get_text(strip=True) if year_cell else None
-                        year_html = year_cell.decode_contents() if year_cell else None
-                        # For content_type (cell 1)
-                        content_type = (
-                            type_cell.get_text(strip=True) if type_cell else None
-                        )
-                        content_type_html = (
-                            type_cell.decode_contents() if type_cell else None
-                        )
-                        # For title and episode_title (cell 2)
-                        title = None
-                        episode_title = None
-                        episode_url = None
-                        title_html = None
-                        # Remove direct child <span> elements from title_cell only if they contain a descendant 'a' tag with 'data-image-name'
-                        if isinstance(title_cell, Tag):
-                            for span in list(
-                                title_cell.find_all("span", recursive=False)
-                            ):
-                                if not isinstance(span, Tag):
-                                    continue
-                                has_image_img = False
-                                for img in span.find_all("img"):
-                                    if (
-                                        isinstance(img, Tag)
-                                        and "data-image-name" in img.attrs
-                                    ):
-                                        has_image_img = True
-                                        break
-                                if has_image_img and img.parent and img.parent.parent:
-                                    img.parent.parent.decompose()
-                                    # span.decompose()
-                            title_html = title_cell.decode_contents()
-                            a_tags = [
-                                a
-                                for a in title_cell.find_all("a")
-                                if isinstance(a, Tag) and a.get("title")
-                            ]
-                            if len(a_tags) >= 2:
-                                title = a_tags[-2].get("title")
-                                episode_title = a_tags[-1].get("title")
-                                episode_url = a_tags[-1].get("href")
-                            elif len(a_tags) == 1:
-                                title = a_tags[0].get("title")
-                                episode_url = a_tags[0].get("href")
-                            if title is None and title_cell.get("title"):
-                                title = title_cell.get("title")
-
-                        # For released (cell 3)
-                        released = (
-                            released_cell.get_text(strip=True)
-                            if released_cell
-                            else None
-                        )
-                        released_html = (
-                            released_cell.decode_contents() if released_cell else None
-                        )
-
-                        # Try to find existing entry
-                        result = await session.execute(
-                            select(CanonMediaEntry).where(
-                                CanonMediaEntry.year == year,
-                                CanonMediaEntry.content_type == content_type,
-                                CanonMediaEntry.title == title,
-                                CanonMediaEntry.episode_title == episode_title,
-                                CanonMediaEntry.released == released,
-                            )
-                        )
-                        existing = result.scalar_one_or_none()
-                        if existing:
-                            # Update fields except watched
-                            if year is not None:
-                                setattr(existing, "year", year)
-                            if year_html is not None:
-                                setattr(existing, "year_html", year_html)
-                            if content_type is not None:
-                                setattr(existing, "content_type", content_type)
-                            if content_type_html is not None:
-                                setattr(
-                                    existing, "content_type_html", content_type_html
-                                )
-                            if title is not None:
-                                setattr(existing, "title", title)
-                            if title_html is not None:
-                                setattr(existing, "title_html", title_html)
-                            if episode_title is not None:
-                                setattr(existing, "episode_title", episode_title)
-                            if episode_url is not None:
-                                setattr(existing, "episode_url", episode_url)
-                            if released is not None:
-                                setattr(existing, "released", released)
-                            if released_html is not None:
-                                setattr(existing, "released_html", released_html)
-                            # watched status is preserved
-                        else:
-                            entry = CanonMediaEntry(
-                                year=year or None,
-                                year_html=year_html,
-                                content_type=content_type or None,
-                                content_type_html=content_type_html,
-                                title=title,
-                                title_html=title_html,
-                                episode_title=episode_title,
-                                episode_url=episode_url,
-                                released=released or None,
-                                released_html=released_html,
-                                watched=False,
-                            )
-                            session.add(entry)
-                        entry_id += 1
-        await session.commit()
+            changed_rows.append({"natural_key": key, **values})
+        # Swaps the *_html values for fragment refs, so the rows can be
+        # written and compared with what is stored
+        await conn.run_sync(intern_fragments, new_rows + changed_rows)
+        stored = {values["natural_key"]: values for values in changed_rows}
+        previous = await _select_by_keys(conn, table, STORED_CONTENT_COLUMNS, updated)
+        gone = await _select_by_keys(conn, table, REPORT_COLUMNS, removed)
+        diff = ImportDiff(
+            inserted=[_describe(by_key[k]) for k in inserted],
+            updated=[
+                {
+                    **_describe(by_key[k]),
+                    "changed": [
+                        c
+                        for c, s in zip(CONTENT_COLUMNS, STORED_CONTENT_COLUMNS)
+                        if stored[k][s] is not None and previous[k][s] != stored[k][s]
+                    ],
+                }
+                for k in updated
+            ],
+            removed=[_describe(values) for values in gone.values()],
+            restored=[_describe(by_key[k]) for k in restored],
+        )
+        await _move_rows(conn, archive, table, restored)
+        stmt = insert(table)
+        # None means "not present in this row", so keep whatever is stored
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[table.c.natural_key],
+            set_={
+                **{
+                    c: func.coalesce(stmt.excluded[c], table.c[c])
+                    for c in STORED_CONTENT_COLUMNS
+                },
+                "content_hash": stmt.excluded.content_hash,
+            },
+        )
+        for pending in (new_rows, changed_rows):
+            for batch in batches(pending, UPSERT_BATCH_SIZE):
+                await conn.execute(stmt, batch)
+        if soft_delete:
+            await _move_rows(conn, table, archive, removed, removed_at=func.now())
+        if updated:
+            await conn.run_sync(prune_fragments)
+    return diff
+
+
+def _describe(values: dict) -> dict:
+    return {c: values[c] for c in REPORT_COLUMNS}
+
+
+async def scrape_and_store(
+    path: str = "media_table.html",
+    parser: str = "bs4",
+    soft_delete: bool = False,
+    report: Optional[str] = None,
+) -> ImportStats:
+    await migrate(engine)
+    started = time.perf_counter()
+    rows = list(PARSERS[parser](path))
+    diff = await upsert_rows(rows, soft_delete)
+    changed = len(diff.inserted) + len(diff.updated) + len(diff.restored)
+    stats = ImportStats(
+        parsed=len(rows),
+        inserted=len(diff.inserted),
+        updated=len(diff.updated),
+        unchanged=len({row.natural_key for row in rows}) - changed,
+        removed=len(diff.removed),
+        restored=len(diff.restored),
+        seconds=time.perf_counter() - started,
+    )
+    print(
+        f"Imported {stats.parsed} rows in {stats.seconds:.2f}s "
+        f"({stats.rows_per_second:.0f} rows/s): {stats.inserted} inserted, "
+        f"{stats.updated} updated, {stats.unchanged} unchanged, "
+        f"{stats.restored} restored, {stats.removed} "
+        f"{'removed' if soft_delete else 'missing upstream'}"
+    )
+    for entry in diff.updated:
+        print(f"  updated {entry['title']}: {', '.join(entry['changed'])}")
+    for entry in diff.removed:
+        print(f"  {'removed' if soft_delete else 'missing'} {entry['title']}")
+    if report:
+        with open(report, "w") as f:
+            json.dump(diff._asdict(), f, indent=2)
+    return stats
 
 
 if __name__ == "__main__":
-    asyncio.run(scrape_and_store())
+    arg_parser = argparse.ArgumentParser(description="Import media_table.html")
+    arg_parser.add_argument("path", nargs="?", default="media_table.html")
+    arg_parser.add_argument("--parser", choices=sorted(PARSERS), default="bs4")
+    arg_parser.add_argument(
+        "--soft-delete",
+        action="store_true",
+        help="Archive entries that are no longer in the HTML",
+    )
+    arg_parser.add_argument("--report", help="Write a JSON diff of the changes here")
+    args = arg_parser.parse_args()
+    asyncio.run(scrape_and_store(args.path, args.parser, args.soft_delete, args.report))
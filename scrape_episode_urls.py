@@ -1,129 +1,357 @@
+import argparse
 import asyncio
-import json
 import os
+import random
+import re
+import time
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlsplit
 
 import aiohttp
 from bs4 import BeautifulSoup, Tag
+from sqlalchemy import bindparam, update
 from sqlalchemy.future import select
 
-from db import AsyncSessionLocal
+from db import AsyncSessionLocal, engine
+from media_parsers import WIKI_ORIGIN
+from migrations import migrate
 from models import CanonMediaEntry
+from page_cache import PageCache
 
 OUTPUT_DIR = "episode_pages"
-os.makedirs(OUTPUT_DIR, exist_ok=True)
-FETCH_DELAY_SECONDS = 0.5
+PAGE_CACHE_MAX_BYTES = int(os.getenv("EPISODE_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+CONCURRENCY = int(os.getenv("EPISODE_FETCH_CONCURRENCY", "4"))
+# Requests per second allowed against a single host, and how many may burst
+RATE_PER_HOST = float(os.getenv("EPISODE_FETCH_RATE", "2"))
+BURST_PER_HOST = int(os.getenv("EPISODE_FETCH_BURST", "4"))
+MAX_RETRIES = 4
+BACKOFF_BASE_SECONDS = 0.5
+REQUEST_TIMEOUT_SECONDS = 30
+# The writer flushes season/episode updates every N results or T seconds
+WRITE_BATCH_SIZE = 200
+WRITE_FLUSH_SECONDS = 2.0
 
 
-async def fetch_and_extract(session, url, entry_id, db_session):
-    import asyncio
+class TokenBucket:
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
 
-    await asyncio.sleep(FETCH_DELAY_SECONDS)
-    try:
-        async with session.get(url) as resp:
-            if resp.status == 200:
-                html = await resp.text()
-                soup = BeautifulSoup(html, "html.parser")
-                season = ""
-                episode = ""
-                # Extract season and episode number from the HTML
-                # Try to find season and episode info in infobox or headings
-                infobox = soup.find(class_="infobox")
-                if infobox and hasattr(infobox, "find_all"):
-                    for row in infobox.find_all("tr"):
-                        if hasattr(row, "find"):
-                            header = row.find("th") if hasattr(row, "find") else None
-                            value = row.find("td") if hasattr(row, "find") else None
-                            if (
-                                header
-                                and value
-                                and hasattr(header, "get_text")
-                                and hasattr(value, "get_text")
-                            ):
-                                h_text = header.get_text(strip=True).lower()
-                                if "season" in h_text:
-                                    season = value.get_text(strip=True)
-                                if "episode" in h_text:
-                                    episode = value.get_text(strip=True)
-                # Fallback: look for headings or other patterns
-                if not season or not episode:
-                    for tag in soup.find_all(["h2", "h3", "h4"]):
-                        if hasattr(tag, "get_text"):
-                            t = tag.get_text(strip=True).lower()
-                            if "season" in t and not season:
-                                season = t
-                            if "episode" in t and not episode:
-                                episode = t
-                # Extract season and episode from pi-item divs
-                season_div = soup.find("div", attrs={"data-source": "season"})
-                episode_div = soup.find("div", attrs={"data-source": "episode"})
-
-                def normalize_season(season_text):
-                    lookup = {
-                        "one": "01",
-                        "two": "02",
-                        "three": "03",
-                        "four": "04",
-                        "five": "05",
-                        "six": "06",
-                        "seven": "07",
-                        "eight": "08",
-                        "nine": "09",
-                        "ten": "10",
-                    }
-                    s = season_text.strip().lower()
-                    return lookup.get(s, s.zfill(2))
-
-                if isinstance(season_div, Tag):
-                    val = season_div.find("div", attrs={"class": "pi-data-value"})
-                    if isinstance(val, Tag):
-                        a = val.find("a")
-                        season_raw = (
-                            a.get_text(strip=True)
-                            if isinstance(a, Tag)
-                            else val.get_text(strip=True)
-                        )
-                        if season_raw:
-                            season = f"S{normalize_season(season_raw)}"
-                if isinstance(episode_div, Tag):
-                    val = episode_div.find("div", attrs={"class": "pi-data-value"})
-                    if isinstance(val, Tag):
-                        import re
-
-                        match = re.search(r"\d+", val.get_text())
-                        if match:
-                            episode = f"E{int(match.group(0)):02d}"
-                print(
-                    f"Entry {entry_id}: season={season}, episode={episode}, url={url}"
-                )
-                # Save season and episode to DB
-                result = await db_session.execute(
-                    select(CanonMediaEntry).where(CanonMediaEntry.id == entry_id)
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.capacity, self._tokens + (now - self._updated) * self.rate
                 )
-                entry = result.scalar_one_or_none()
-                if entry:
-                    entry.season = season
-                    entry.episode = episode
-                    await db_session.commit()
-            else:
-                print(f"Failed to fetch {url}: {resp.status}")
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class HostRateLimiter:
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._buckets: Dict[str, TokenBucket] = {}
+
+    async def acquire(self, url: str):
+        host = urlsplit(url).netloc
+        bucket = self._buckets.get(host)
+        if bucket is None:
+            bucket = self._buckets[host] = TokenBucket(self.rate, self.capacity)
+        await bucket.acquire()
+
+
+def _retry_delay(attempt: int, retry_after: Optional[str]) -> float:
+    delay = BACKOFF_BASE_SECONDS * 2**attempt * (1 + random.random() / 2)
+    if retry_after and retry_after.isdigit():
+        delay = max(delay, float(retry_after))
+    return delay
+
+
+async def fetch_page(session, url, limiter, headers=None):
+    # Retries 429/5xx responses and connection errors with exponential backoff.
+    # Returns the status, the body (None unless 200) and the response headers.
+    for attempt in range(MAX_RETRIES + 1):
+        await limiter.acquire(url)
+        try:
+            async with session.get(url, headers=headers) as resp:
+                if resp.status == 429 or resp.status >= 500:
+                    if attempt == MAX_RETRIES:
+                        return resp.status, None, resp.headers
+                    retry_after = resp.headers.get("Retry-After")
+                elif resp.status == 200:
+                    return resp.status, await resp.text(), resp.headers
+                else:
+                    return resp.status, None, resp.headers
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            if attempt == MAX_RETRIES:
+                raise
+            retry_after = None
+        await asyncio.sleep(_retry_delay(attempt, retry_after))
+    raise AssertionError("unreachable")
+
+
+def normalize_season(season_text):
+    lookup = {
+        "one": "01",
+        "two": "02",
+        "three": "03",
+        "four": "04",
+        "five": "05",
+        "six": "06",
+        "seven": "07",
+        "eight": "08",
+        "nine": "09",
+        "ten": "10",
+    }
+    s = season_text.strip().lower()
+    return lookup.get(s, s.zfill(2))
+
+
+def extract_season_episode(html) -> Tuple[str, str]:
+    soup = BeautifulSoup(html, "html.parser")
+    season = ""
+    episode = ""
+    # Extract season and episode number from the HTML
+    # Try to find season and episode info in infobox or headings
+    infobox = soup.find(class_="infobox")
+    if infobox and hasattr(infobox, "find_all"):
+        for row in infobox.find_all("tr"):
+            if hasattr(row, "find"):
+                header = row.find("th") if hasattr(row, "find") else None
+                value = row.find("td") if hasattr(row, "find") else None
+                if (
+                    header
+                    and value
+                    and hasattr(header, "get_text")
+                    and hasattr(value, "get_text")
+                ):
+                    h_text = header.get_text(strip=True).lower()
+                    if "season" in h_text:
+                        season = value.get_text(strip=True)
+                    if "episode" in h_text:
+                        episode = value.get_text(strip=True)
+    # Fallback: look for headings or other patterns
+    if not season or not episode:
+        for tag in soup.find_all(["h2", "h3", "h4"]):
+            if hasattr(tag, "get_text"):
+                t = tag.get_text(strip=True).lower()
+                if "season" in t and not season:
+                    season = t
+                if "episode" in t and not episode:
+                    episode = t
+    # Extract season and episode from pi-item divs
+    season_div = soup.find("div", attrs={"data-source": "season"})
+    episode_div = soup.find("div", attrs={"data-source": "episode"})
+    if isinstance(season_div, Tag):
+        val = season_div.find("div", attrs={"class": "pi-data-value"})
+        if isinstance(val, Tag):
+            a = val.find("a")
+            season_raw = (
+                a.get_text(strip=True)
+                if isinstance(a, Tag)
+                else val.get_text(strip=True)
+            )
+            if season_raw:
+                season = f"S{normalize_season(season_raw)}"
+    if isinstance(episode_div, Tag):
+        val = episode_div.find("div", attrs={"class": "pi-data-value"})
+        if isinstance(val, Tag):
+            match = re.search(r"\d+", val.get_text())
+            if match:
+                episode = f"E{int(match.group(0)):02d}"
+    return season, episode
+
+
+async def write_results(
+    results: asyncio.Queue,
+    batch_size: int = WRITE_BATCH_SIZE,
+    flush_seconds: float = WRITE_FLUSH_SECONDS,
+):
+    # The only task that touches the database while fetching. It receives
+    # (id, season, episode) tuples and writes them with one executemany UPDATE
+    # per batch; None on the queue flushes what is left and stops it.
+    table = CanonMediaEntry.__table__
+    stmt = (
+        update(table)
+        .where(table.c.id == bindparam("b_id"))
+        .values(season=bindparam("b_season"), episode=bindparam("b_episode"))
+    )
+    loop = asyncio.get_running_loop()
+    pending = []
+    deadline = None
+    written = 0
+
+    async def flush():
+        nonlocal pending, deadline, written
+        if pending:
+            async with engine.begin() as conn:
+                await conn.execute(stmt, pending)
+            written += len(pending)
+        pending = []
+        deadline = None
+
+    while True:
+        timeout = None if deadline is None else max(0.0, deadline - loop.time())
+        try:
+            item = await asyncio.wait_for(results.get(), timeout)
+        except asyncio.TimeoutError:
+            await flush()
+            continue
+        if item is None:
+            await flush()
+            return written
+        entry_id, season, episode = item
+        pending.append({"b_id": entry_id, "b_season": season, "b_episode": episode})
+        if deadline is None:
+            deadline = loop.time() + flush_seconds
+        if len(pending) >= batch_size:
+            await flush()
+
+
+async def fetch_and_extract(
+    session, url, fetch_url, entry_id, results, limiter, page_cache
+):
+    # Pages are cached under their wiki URL even when fetched from base_url
+    try:
+        cached = page_cache.get(url)
+        status, html, headers = await fetch_page(
+            session, fetch_url, limiter, page_cache.conditional_headers(cached)
+        )
+        if status == 304 and cached is not None:
+            # Unchanged upstream: reuse what was extracted last time
+            season, episode = cached.season, cached.episode
+        elif status == 200:
+            season, episode = extract_season_episode(html)
+            page_cache.put(
+                url,
+                html,
+                headers.get("ETag"),
+                headers.get("Last-Modified"),
+                season,
+                episode,
+            )
+        else:
+            print(f"Failed to fetch {url}: {status}")
+            return
+        print(f"Entry {entry_id}: season={season}, episode={episode}, url={url}")
+        await results.put((entry_id, season, episode))
     except Exception as e:
         print(f"Error fetching {url}: {e}")
 
 
-async def scrape_episode_urls():
+async def extract_offline(url, entry_id, results, page_cache):
+    cached = page_cache.get(url)
+    if cached is None:
+        print(f"Not cached: {url}")
+        return
+    html = page_cache.read(cached)
+    season, episode = extract_season_episode(html)
+    page_cache.put(
+        url,
+        html,
+        cached.etag,
+        cached.last_modified,
+        season,
+        episode,
+    )
+    print(f"Entry {entry_id}: season={season}, episode={episode}, url={url}")
+    await results.put((entry_id, season, episode))
+
+
+async def scrape_episode_urls(
+    concurrency: int = CONCURRENCY,
+    rate: float = RATE_PER_HOST,
+    burst: int = BURST_PER_HOST,
+    base_url: Optional[str] = None,
+    offline: bool = False,
+):
+    # base_url points the fetcher at a stand-in server instead of the wiki;
+    # offline re-extracts from cached pages without touching the network.
+    await migrate(engine)
+    page_cache = PageCache(OUTPUT_DIR, PAGE_CACHE_MAX_BYTES)
+    limiter = HostRateLimiter(rate, burst)
+    queue: asyncio.Queue = asyncio.Queue()
     async with AsyncSessionLocal() as db_session:
-        result = await db_session.execute(select(CanonMediaEntry))
-        entries = result.scalars().all()
-        async with aiohttp.ClientSession() as http_session:
-            for entry in entries:
-                if (
-                    getattr(entry, "episode_url", None)
-                    and getattr(entry, "content_type", None) == "TV"
-                ):
-                    await fetch_and_extract(
-                        http_session, entry.episode_url, entry.id, db_session
-                    )
+        result = await db_session.execute(
+            select(CanonMediaEntry.id, CanonMediaEntry.episode_url).where(
+                CanonMediaEntry.content_type == "TV",
+                CanonMediaEntry.episode_url.is_not(None),
+                CanonMediaEntry.episode_url != "",
+            )
+        )
+        for entry_id, url in result:
+            fetch_url = url
+            if base_url and url.startswith(WIKI_ORIGIN):
+                fetch_url = base_url.rstrip("/") + url[len(WIKI_ORIGIN) :]
+            queue.put_nowait((entry_id, url, fetch_url))
+
+    results: asyncio.Queue = asyncio.Queue()
+    writer = asyncio.create_task(write_results(results))
+    try:
+        if offline:
+            while not queue.empty():
+                entry_id, url, _ = queue.get_nowait()
+                await extract_offline(url, entry_id, results, page_cache)
+        else:
+            connector = aiohttp.TCPConnector(
+                limit=concurrency,
+                limit_per_host=concurrency,
+                ttl_dns_cache=300,
+                keepalive_timeout=30,
+            )
+            timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT_SECONDS)
+            async with aiohttp.ClientSession(
+                connector=connector, timeout=timeout
+            ) as http_session:
+
+                async def worker():
+                    while True:
+                        entry_id, url, fetch_url = await queue.get()
+                        try:
+                            await fetch_and_extract(
+                                http_session,
+                                url,
+                                fetch_url,
+                                entry_id,
+                                results,
+                                limiter,
+                                page_cache,
+                            )
+                        finally:
+                            queue.task_done()
+
+                workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+                await queue.join()
+                for task in workers:
+                    task.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
+    finally:
+        await results.put(None)
+        written = await writer
+        page_cache.save()
+    print(f"Updated season/episode for {written} entries")
 
 
 if __name__ == "__main__":
-    asyncio.run(scrape_episode_urls())
+    parser = argparse.ArgumentParser(description="Fetch TV season/episode numbers")
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY)
+    parser.add_argument("--rate", type=float, default=RATE_PER_HOST)
+    parser.add_argument("--burst", type=int, default=BURST_PER_HOST)
+    parser.add_argument("--base-url", help="Fetch pages from this origin instead")
+    parser.add_argument(
+        "--offline", action="store_true", help="Re-extract from cached pages only"
+    )
+    args = parser.parse_args()
+    asyncio.run(
+        scrape_episode_urls(
+            args.concurrency, args.rate, args.burst, args.base_url, args.offline
+        )
+    )
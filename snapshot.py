@@ -0,0 +1,305 @@
+import argparse
+import asyncio
+import mmap
+import os
+import struct
+import sys
+import time
+import zlib
+from array import array
+from typing import List, NamedTuple, Optional
+
+from pydantic import TypeAdapter
+from sqlalchemy import delete, func, insert, select
+
+from db import engine
+from fragments import (
+    cell_refs,
+    intern_fragments,
+    join_cell,
+    load_fragments,
+    normalize_row,
+    prune_fragments,
+    resolve_cell,
+)
+from migrations import migrate
+from models import (
+    HTML_COLUMNS,
+    CanonMediaEntry,
+    CanonMediaEntrySchema,
+    RemovedMediaEntry,
+    WatchState,
+    make_content_hash,
+    make_natural_key,
+)
+
+# Columnar snapshot of canon_media. After the header, every schema field is
+# stored as one length-prefixed column block:
+#   header: magic, row count, column count, flags
+#   column: name length, name, kind, payload length, payload
+# Payloads hold a validity byte per row followed by the values: int64s for
+# int columns, one byte per row for bool columns, and for str columns
+# (row count + 1) uint32 offsets into a UTF-8 blob. With FLAG_ZLIB each
+# payload is zlib-compressed; otherwise the columns are read straight out of
+# the memory-mapped file. All numbers are little-endian.
+MAGIC = b"CMSNAP\x00\x01"
+HEADER = struct.Struct("<8sIHB")
+COLUMN_NAME = struct.Struct("<H")
+COLUMN_INFO = struct.Struct("<BQ")
+FLAG_ZLIB = 1
+KIND_STR, KIND_INT, KIND_BOOL = 0, 1, 2
+DEFAULT_PATH = "canon_media.snapshot"
+# Restored into an empty database at startup, so a server can come up without
+# running the HTML importer
+CATALOGUE_SNAPSHOT = os.getenv("CATALOGUE_SNAPSHOT")
+SWAP_BYTES = sys.byteorder != "little"
+
+
+class SnapshotError(ValueError):
+    pass
+
+
+class SnapshotColumn(NamedTuple):
+    name: str
+    kind: int
+
+
+def _kind(annotation) -> int:
+    if annotation is bool:
+        return KIND_BOOL
+    if annotation is int or annotation == Optional[int]:
+        return KIND_INT
+    return KIND_STR
+
+
+ROWS_ADAPTER = TypeAdapter(List[CanonMediaEntrySchema])
+COLUMNS = [
+    SnapshotColumn(name, _kind(field.annotation))
+    for name, field in CanonMediaEntrySchema.model_fields.items()
+]
+
+
+def _little_endian(values: array) -> bytes:
+    if SWAP_BYTES:
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def _encode_column(kind: int, values: list) -> bytes:
+    validity = bytes(value is not None for value in values)
+    if kind == KIND_BOOL:
+        return validity + bytes(bool(value) for value in values)
+    if kind == KIND_INT:
+        ints = array("q", (value or 0 for value in values))
+        return validity + _little_endian(ints)
+    offsets = array("I", [0])
+    blob = bytearray()
+    for value in values:
+        if value is not None:
+            blob += value.encode()
+        offsets.append(len(blob))
+    return validity + _little_endian(offsets) + bytes(blob)
+
+
+def _decode_column(kind: int, payload: memoryview, count: int) -> list:
+    validity = bytes(payload[:count])
+    body = payload[count:]
+    if kind == KIND_BOOL:
+        return [
+            bool(value) if valid else None
+            for valid, value in zip(validity, bytes(body[:count]))
+        ]
+    if kind == KIND_INT:
+        ints = array("q")
+        ints.frombytes(body[: count * 8])
+        if SWAP_BYTES:
+            ints.byteswap()
+        return [value if valid else None for valid, value in zip(validity, ints)]
+    offsets = array("I")
+    offsets.frombytes(body[: (count + 1) * 4])
+    if SWAP_BYTES:
+        offsets.byteswap()
+    # One copy of the blob out of the mapping; slicing bytes beats slicing
+    # the memoryview row by row
+    blob = bytes(body[(count + 1) * 4 :])
+    return [
+        blob[start:end].decode() if valid else None
+        for valid, start, end in zip(validity, offsets, offsets[1:])
+    ]
+
+
+def write_snapshot(
+    path: str, rows: List[CanonMediaEntrySchema], compress: bool = False
+) -> int:
+    flags = FLAG_ZLIB if compress else 0
+    with open(path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, len(rows), len(COLUMNS), flags))
+        for column in COLUMNS:
+            payload = _encode_column(
+                column.kind, [getattr(row, column.name) for row in rows]
+            )
+            if compress:
+                payload = zlib.compress(payload)
+            name = column.name.encode()
+            f.write(COLUMN_NAME.pack(len(name)) + name)
+            f.write(COLUMN_INFO.pack(column.kind, len(payload)))
+            f.write(payload)
+        return f.tell()
+
+
+def read_snapshot(path: str) -> List[CanonMediaEntrySchema]:
+    with open(path, "rb") as f:
+        # mmap refuses empty files
+        if os.fstat(f.fileno()).st_size < HEADER.size:
+            raise SnapshotError("Snapshot is truncated")
+        error = None
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(mapped)
+            try:
+                columns = _read_columns(view)
+            except struct.error:
+                # A column header cut short
+                error = SnapshotError("Snapshot is truncated")
+            except SnapshotError as e:
+                error = e.with_traceback(None)
+            finally:
+                view.release()
+    # Raised once the mapping is closed: a traceback into _read_columns keeps
+    # slices of it alive, and mmap can't close while they exist
+    if error is not None:
+        raise error
+    names = list(columns)
+    return ROWS_ADAPTER.validate_python(
+        [dict(zip(names, values)) for values in zip(*columns.values())]
+    )
+
+
+def _read_columns(view: memoryview) -> dict:
+    if len(view) < HEADER.size:
+        raise SnapshotError("Snapshot is truncated")
+    magic, count, column_count, flags = HEADER.unpack_from(view)
+    if magic != MAGIC:
+        raise SnapshotError("Not a canon_media snapshot")
+    known = {column.name: column.kind for column in COLUMNS}
+    columns = {}
+    position = HEADER.size
+    for _ in range(column_count):
+        (name_length,) = COLUMN_NAME.unpack_from(view, position)
+        position += COLUMN_NAME.size
+        name = str(view[position : position + name_length], "utf-8")
+        position += name_length
+        kind, length = COLUMN_INFO.unpack_from(view, position)
+        position += COLUMN_INFO.size
+        payload = view[position : position + length]
+        position += length
+        if len(payload) != length:
+            raise SnapshotError("Snapshot is truncated")
+        if name not in known:
+            # Written by a newer schema; the column is not used here
+            continue
+        if kind != known[name]:
+            raise SnapshotError(f"Column {name} has an unexpected type")
+        if flags & FLAG_ZLIB:
+            payload = memoryview(zlib.decompress(payload))
+        columns[name] = _decode_column(kind, payload, count)
+    missing = [
+        name
+        for name, field in CanonMediaEntrySchema.model_fields.items()
+        if name not in columns and field.is_required()
+    ]
+    if missing:
+        raise SnapshotError(f"Snapshot is missing columns: {', '.join(missing)}")
+    return columns
+
+
+async def export_snapshot(path: str = DEFAULT_PATH, compress: bool = False) -> int:
+    await migrate(engine)
+    started = time.perf_counter()
+    async with engine.connect() as conn:
+        fragments = await conn.run_sync(load_fragments)
+        result = await conn.execute(
+            select(CanonMediaEntry).order_by(CanonMediaEntry.id)
+        )
+        rows = [
+            CanonMediaEntrySchema.model_validate(m).model_copy(
+                update={
+                    name: join_cell(resolve_cell(fragments, refs))
+                    for name, refs in zip(HTML_COLUMNS, cell_refs(m))
+                }
+            )
+            for m in result
+        ]
+    size = write_snapshot(path, rows, compress)
+    print(
+        f"Exported {len(rows)} rows to {path} ({size} bytes) "
+        f"in {time.perf_counter() - started:.2f}s"
+    )
+    return len(rows)
+
+
+async def import_snapshot(path: str = DEFAULT_PATH) -> List[CanonMediaEntrySchema]:
+    # Replaces the catalogue with the snapshot's rows, ids and watched flags
+    # included; per-user progress on entries that no longer exist is dropped.
+    # Archived entries stay restorable unless the snapshot reuses their id or
+    # natural key.
+    await migrate(engine)
+    started = time.perf_counter()
+    # Snapshots keep the order they were written in; Catalogue.load needs
+    # rows in id order
+    rows = sorted(read_snapshot(path), key=lambda row: row.id)
+    values = []
+    for row in rows:
+        fields = normalize_row(row.model_dump())
+        fields["natural_key"] = make_natural_key(
+            row.year, row.content_type, row.title, row.episode_title, row.released
+        )
+        fields["content_hash"] = make_content_hash(fields)
+        values.append(fields)
+    async with engine.begin() as conn:
+        await conn.execute(delete(CanonMediaEntry))
+        await conn.run_sync(intern_fragments, values)
+        if values:
+            await conn.execute(insert(CanonMediaEntry), values)
+        await conn.execute(
+            delete(RemovedMediaEntry).where(
+                RemovedMediaEntry.id.in_(select(CanonMediaEntry.id))
+                | RemovedMediaEntry.natural_key.in_(select(CanonMediaEntry.natural_key))
+            )
+        )
+        await conn.execute(
+            delete(WatchState).where(
+                WatchState.media_id.not_in(select(CanonMediaEntry.id)),
+                WatchState.media_id.not_in(select(RemovedMediaEntry.id)),
+            )
+        )
+        await conn.run_sync(prune_fragments)
+    print(
+        f"Imported {len(rows)} rows from {path} "
+        f"in {time.perf_counter() - started:.2f}s"
+    )
+    return rows
+
+
+async def restore_if_empty(path: str) -> Optional[List[CanonMediaEntrySchema]]:
+    async with engine.connect() as conn:
+        count = (
+            await conn.execute(select(func.count()).select_from(CanonMediaEntry))
+        ).scalar_one()
+    if count:
+        return None
+    return await import_snapshot(path)
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Catalogue snapshots")
+    arg_parser.add_argument("command", choices=["export", "import"])
+    arg_parser.add_argument("path", nargs="?", default=DEFAULT_PATH)
+    arg_parser.add_argument(
+        "--compress", action="store_true", help="zlib-compress each column"
+    )
+    args = arg_parser.parse_args()
+    if args.command == "export":
+        asyncio.run(export_snapshot(args.path, args.compress))
+    else:
+        asyncio.run(import_snapshot(args.path))
@@ -0,0 +1,6 @@
+import os
+import tempfile
+
+# db binds its engine to SQLITE_PATH when first imported, so point it at a
+# scratch database before any test module imports the app
+os.environ["SQLITE_PATH"] = os.path.join(tempfile.mkdtemp(), "test.db")
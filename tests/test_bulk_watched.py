@@ -0,0 +1,84 @@
+import asyncio
+
+import httpx
+import pytest
+from pydantic import ValidationError
+
+from db import engine
+from main import app
+from models import BulkWatchedUpdate, CanonMediaEntrySchema
+from snapshot import import_snapshot, write_snapshot
+
+
+def episode(media_id: int, title: str, season: str) -> CanonMediaEntrySchema:
+    return CanonMediaEntrySchema(
+        id=media_id,
+        year="19 BBY",
+        content_type="TV",
+        title=title,
+        episode_title=f"Episode {media_id}",
+        episode_url=None,
+        released="2008-10-03",
+        watched=False,
+        season=season,
+        episode=f"E{media_id:02d}",
+    )
+
+
+ROWS = [
+    episode(1, "Star Wars Rebels", "S01"),
+    episode(2, "Star Wars Rebels", "S01"),
+    episode(3, "Star Wars Rebels", "S02"),
+    episode(4, "Star Wars: The Clone Wars", "S01"),
+]
+
+
+@pytest.mark.parametrize(
+    "body",
+    [
+        {},
+        {"ids": []},
+        {"content_type": []},
+        {"content_type": [], "user_id": "u"},
+        {"season": "S01"},
+        {"content_type": ["TV"], "season": "S01"},
+    ],
+)
+def test_rejects_selections_without_an_effective_filter(body):
+    with pytest.raises(ValidationError):
+        BulkWatchedUpdate(watched=True, **body)
+
+
+def test_season_of_one_series(tmp_path):
+    path = tmp_path / "episodes.snapshot"
+    write_snapshot(str(path), ROWS)
+    season = {"title": "Star Wars Rebels", "season": "S01"}
+
+    async def run():
+        try:
+            await import_snapshot(str(path))
+            async with app.router.lifespan_context(app):
+                transport = httpx.ASGITransport(app=app)
+                async with httpx.AsyncClient(
+                    transport=transport, base_url="http://test"
+                ) as client:
+                    shared = await client.post(
+                        "/media/watched", json={"watched": True, **season}
+                    )
+                    user = await client.post(
+                        "/media/watched",
+                        json={"watched": True, "user_id": "u", **season},
+                    )
+                    rejected = await client.post(
+                        "/media/watched", json={"watched": True, "season": "S01"}
+                    )
+                    watched = await client.get("/media", params={"watched": "true"})
+                    return shared, user, rejected, watched
+        finally:
+            await engine.dispose()
+
+    shared, user, rejected, watched = asyncio.run(run())
+    assert shared.json()["ids"] == [1, 2]
+    assert user.json()["ids"] == [1, 2]
+    assert rejected.status_code == 422
+    assert [m["id"] for m in watched.json()] == [1, 2]
@@ -0,0 +1,45 @@
+import asyncio
+
+import httpx
+
+from db import engine
+from main import app
+
+
+async def get_table(headers: dict, revalidate_headers: dict = None) -> list:
+    # Fetches /media/table, then again with the ETag it got back
+    try:
+        async with app.router.lifespan_context(app):
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(
+                transport=transport, base_url="http://test"
+            ) as client:
+                first = await client.get("/media/table", headers=headers)
+                revalidated = await client.get(
+                    "/media/table",
+                    headers={
+                        **(revalidate_headers or headers),
+                        "If-None-Match": first.headers["ETag"],
+                    },
+                )
+                return [first, revalidated]
+    finally:
+        await engine.dispose()
+
+
+def test_not_modified_keeps_encoded_etag():
+    first, revalidated = asyncio.run(get_table({"Accept-Encoding": "gzip"}))
+    assert first.status_code == 200
+    assert first.headers["Content-Encoding"] == "gzip"
+    assert first.headers["ETag"].endswith('-gzip"')
+    assert revalidated.status_code == 304
+    assert revalidated.headers["ETag"] == first.headers["ETag"]
+
+
+def test_encoded_etag_does_not_validate_identity():
+    compressed, identity = asyncio.run(
+        get_table({"Accept-Encoding": "gzip"}, {"Accept-Encoding": "identity"})
+    )
+    assert identity.status_code == 200
+    assert "Content-Encoding" not in identity.headers
+    assert identity.headers["ETag"] != compressed.headers["ETag"]
@@ -0,0 +1,30 @@
+import asyncio
+
+import pytest
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+from db import make_engine
+from metrics import STATEMENT_SECONDS, instrument_engine
+
+
+def test_failed_statements_leave_nothing_on_the_connection(tmp_path):
+    engine = make_engine(f"sqlite+aiosqlite:///{tmp_path / 'metrics.db'}")
+    instrument_engine(engine)
+
+    async def run():
+        try:
+            async with engine.connect() as conn:
+                for _ in range(3):
+                    with pytest.raises(OperationalError):
+                        await conn.execute(text("SELECT * FROM missing_table"))
+                before = STATEMENT_SECONDS.render()
+                await conn.execute(text("SELECT 1"))
+                info = dict(conn.sync_connection.info)
+                return before, STATEMENT_SECONDS.render(), info
+        finally:
+            await engine.dispose()
+
+    before, after, info = asyncio.run(run())
+    assert not any(isinstance(value, list) for value in info.values())
+    assert after != before
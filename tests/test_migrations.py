@@ -0,0 +1,163 @@
+import asyncio
+import sqlite3
+
+from sqlalchemy import delete, select, text, update
+
+from benchmarks.synthetic import generate_rows
+from db import engine, make_engine
+from fragments import cell_refs, join_cell, load_fragments, resolve_cell
+from migrations import MIGRATIONS, migrate
+from models import (
+    HTML_COLUMNS,
+    CanonMediaEntry,
+    RemovedMediaEntry,
+    WatchState,
+)
+from queries import stats_query
+from scrape_canon_media import upsert_rows
+
+# canon_media as created by the first release, before any migration
+BASELINE_SCHEMA = """
+CREATE TABLE canon_media (
+    id INTEGER NOT NULL,
+    year VARCHAR(32),
+    year_html VARCHAR(512),
+    content_type VARCHAR(64),
+    content_type_html VARCHAR(512),
+    title VARCHAR(256) NOT NULL,
+    episode_title VARCHAR(256),
+    episode_url VARCHAR(512),
+    title_html VARCHAR(512),
+    released VARCHAR(64),
+    released_html VARCHAR(512),
+    watched BOOLEAN,
+    season VARCHAR(8) NOT NULL,
+    episode VARCHAR(8) NOT NULL,
+    PRIMARY KEY (id)
+)
+"""
+SEARCHES = ["Jedi", "Rebels", "Sha*", "TV"]
+
+
+def catalogue_rows():
+    rows = list(generate_rows(60, seed=3))
+    # Old imports stored an empty year as NULL but looked it up as ''
+    rows[5] = rows[5]._replace(year=None, year_html=None)
+    progress = {}
+    for i, row in enumerate(rows):
+        season = f"S0{i % 3 + 1}" if row.content_type == "TV" else ""
+        episode = f"E{i:02d}" if season else ""
+        progress[row.natural_key] = (i % 3 == 0, season, episode)
+    return rows, progress
+
+
+def write_baseline(path, rows, progress):
+    values = []
+    for row in rows:
+        watched, season, episode = progress[row.natural_key]
+        values.append(
+            {
+                **row._asdict(),
+                # The wiki's source indentation, as stored before migration 7
+                "title_html": f"\n      {row.title_html}\n    ",
+                "watched": watched,
+                "season": season,
+                "episode": episode,
+            }
+        )
+    # A duplicate of the NULL-year row, watched, and an exact duplicate
+    values.append({**values[5], "year": "", "watched": True})
+    values.append(dict(values[7]))
+    progress[rows[5].natural_key] = (True, *progress[rows[5].natural_key][1:])
+    columns = list(values[0])
+    with sqlite3.connect(path) as conn:
+        conn.execute(BASELINE_SCHEMA)
+        conn.executemany(
+            f"INSERT INTO canon_media ({', '.join(columns)}) "
+            f"VALUES ({', '.join(':' + c for c in columns)})",
+            values,
+        )
+    conn.close()
+
+
+async def fresh_import(rows, progress):
+    await migrate(engine)
+    async with engine.begin() as conn:
+        for model in (WatchState, RemovedMediaEntry, CanonMediaEntry):
+            await conn.execute(delete(model))
+    await upsert_rows(rows)
+    table = CanonMediaEntry.__table__
+    async with engine.begin() as conn:
+        for key, (watched, season, episode) in progress.items():
+            await conn.execute(
+                update(table)
+                .where(table.c.natural_key == key)
+                .values(watched=watched, season=season, episode=episode)
+            )
+
+
+def contents(conn):
+    fragments = load_fragments(conn)
+    rows = {}
+    for m in conn.execute(select(CanonMediaEntry)):
+        cells = (join_cell(resolve_cell(fragments, refs)) for refs in cell_refs(m))
+        rows[m.natural_key] = (
+            bool(m.watched),
+            m.season,
+            m.episode,
+            m.content_hash,
+            dict(zip(HTML_COLUMNS, cells)),
+        )
+    conn.execute(
+        text("INSERT INTO canon_media_fts (canon_media_fts) VALUES ('integrity-check')")
+    )
+    found = {
+        q: sorted(
+            conn.execute(
+                text(
+                    "SELECT m.natural_key FROM canon_media_fts "
+                    "JOIN canon_media AS m ON m.id = canon_media_fts.rowid "
+                    "WHERE canon_media_fts MATCH :q"
+                ),
+                {"q": q},
+            ).scalars()
+        )
+        for q in SEARCHES
+    }
+    stats = conn.execute(stats_query()).all()
+    return rows, found, stats
+
+
+def test_baseline_database_migrates_to_a_fresh_import(tmp_path):
+    path = tmp_path / "baseline.db"
+    rows, progress = catalogue_rows()
+    write_baseline(str(path), rows, progress)
+    migrated_engine = make_engine(f"sqlite+aiosqlite:///{path}")
+
+    async def run():
+        try:
+            await migrate(migrated_engine)
+            async with migrated_engine.connect() as conn:
+                version = (await conn.execute(text("PRAGMA user_version"))).scalar()
+                migrated = await conn.run_sync(contents)
+            await fresh_import(rows, progress)
+            async with engine.connect() as conn:
+                fresh = await conn.run_sync(contents)
+            return version, migrated, fresh
+        finally:
+            await migrated_engine.dispose()
+            await engine.dispose()
+
+    version, migrated, fresh = asyncio.run(run())
+    assert version == len(MIGRATIONS)
+    migrated_rows, migrated_found, migrated_stats = migrated
+    fresh_rows, fresh_found, fresh_stats = fresh
+    assert len(migrated_rows) == len(rows)
+    assert migrated_rows == fresh_rows
+    # The duplicates are merged into one watched row, indentation collapsed
+    assert migrated_rows[rows[5].natural_key][0] is True
+    title_html = migrated_rows[rows[0].natural_key][4]["title_html"]
+    assert title_html == rows[0].title_html
+    assert migrated_found == fresh_found
+    assert all(migrated_found.values())
+    assert migrated_stats == fresh_stats
@@ -0,0 +1,127 @@
+import asyncio
+import time
+from collections import Counter
+from contextlib import asynccontextmanager
+
+import aiohttp
+from aiohttp import web
+
+import scrape_episode_urls
+from scrape_episode_urls import HostRateLimiter, TokenBucket, fetch_page
+
+
+def make_app(attempts: Counter) -> web.Application:
+    async def flaky(request):
+        attempts["flaky"] += 1
+        if attempts["flaky"] == 1:
+            return web.Response(status=503)
+        return web.Response(text="<h1>Episode</h1>")
+
+    async def throttled(request):
+        attempts["throttled"] += 1
+        if attempts["throttled"] == 1:
+            return web.Response(status=429, headers={"Retry-After": "1"})
+        return web.Response(text="<h1>Episode</h1>")
+
+    async def broken(request):
+        attempts["broken"] += 1
+        return web.Response(status=500)
+
+    async def missing(request):
+        attempts["missing"] += 1
+        return web.Response(status=404)
+
+    app = web.Application()
+    app.router.add_get("/wiki/Flaky", flaky)
+    app.router.add_get("/wiki/Throttled", throttled)
+    app.router.add_get("/wiki/Broken", broken)
+    app.router.add_get("/wiki/Missing", missing)
+    return app
+
+
+@asynccontextmanager
+async def serve(attempts: Counter):
+    runner = web.AppRunner(make_app(attempts))
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    try:
+        async with aiohttp.ClientSession() as session:
+            yield session, f"http://127.0.0.1:{port}"
+    finally:
+        await runner.cleanup()
+
+
+def fetch(path: str, attempts: Counter):
+    async def run():
+        async with serve(attempts) as (session, base_url):
+            limiter = HostRateLimiter(rate=1000, capacity=10)
+            started = time.monotonic()
+            result = await fetch_page(session, base_url + path, limiter)
+            return result, time.monotonic() - started
+
+    return asyncio.run(run())
+
+
+def test_retries_server_error_then_succeeds(monkeypatch):
+    monkeypatch.setattr(scrape_episode_urls, "BACKOFF_BASE_SECONDS", 0.01)
+    attempts = Counter()
+    (status, body, _), _ = fetch("/wiki/Flaky", attempts)
+    assert status == 200
+    assert body == "<h1>Episode</h1>"
+    assert attempts["flaky"] == 2
+
+
+def test_waits_for_retry_after(monkeypatch):
+    monkeypatch.setattr(scrape_episode_urls, "BACKOFF_BASE_SECONDS", 0.01)
+    attempts = Counter()
+    (status, body, _), elapsed = fetch("/wiki/Throttled", attempts)
+    assert status == 200
+    assert attempts["throttled"] == 2
+    assert elapsed >= 1
+
+
+def test_gives_up_after_max_retries(monkeypatch):
+    monkeypatch.setattr(scrape_episode_urls, "BACKOFF_BASE_SECONDS", 0.01)
+    attempts = Counter()
+    (status, body, _), _ = fetch("/wiki/Broken", attempts)
+    assert status == 500
+    assert body is None
+    assert attempts["broken"] == scrape_episode_urls.MAX_RETRIES + 1
+
+
+def test_does_not_retry_client_errors():
+    attempts = Counter()
+    (status, body, _), _ = fetch("/wiki/Missing", attempts)
+    assert status == 404
+    assert body is None
+    assert attempts["missing"] == 1
+
+
+def test_token_bucket_paces_after_burst():
+    async def run():
+        bucket = TokenBucket(rate=50, capacity=2)
+        started = time.monotonic()
+        times = []
+        for _ in range(7):
+            await bucket.acquire()
+            times.append(time.monotonic() - started)
+        return times
+
+    times = asyncio.run(run())
+    # The burst goes out at once, the rest one token (20 ms) apart
+    assert times[1] < 0.01
+    assert times[-1] >= 5 / 50 * 0.9
+    assert all(b - a >= 1 / 50 * 0.9 for a, b in zip(times[2:], times[3:]))
+
+
+def test_rate_limiter_keeps_one_bucket_per_host():
+    async def run():
+        limiter = HostRateLimiter(rate=1, capacity=1)
+        started = time.monotonic()
+        await limiter.acquire("http://a.example/wiki/One")
+        await limiter.acquire("http://b.example/wiki/One")
+        return time.monotonic() - started
+
+    assert asyncio.run(run()) < 0.5
@@ -0,0 +1,209 @@
+import asyncio
+
+import pytest
+from sqlalchemy import delete, insert, select
+
+from catalogue import Catalogue
+from db import engine
+from migrations import migrate
+from models import (
+    CanonMediaEntrySchema,
+    MediaFilter,
+    RemovedMediaEntry,
+    WatchState,
+    make_natural_key,
+)
+from snapshot import (
+    COLUMN_INFO,
+    COLUMN_NAME,
+    HEADER,
+    KIND_INT,
+    SnapshotError,
+    export_snapshot,
+    import_snapshot,
+    read_snapshot,
+    write_snapshot,
+)
+
+
+def make_row(media_id: int, **fields) -> CanonMediaEntrySchema:
+    values = dict(
+        id=media_id,
+        year="19 BBY",
+        year_html='<a href="https://starwars.fandom.com/wiki/19_BBY">19 BBY</a>',
+        content_type="TV",
+        content_type_html="TV",
+        title="Star Wars: The Clone Wars",
+        episode_title=f"Episode {media_id}",
+        episode_url=f"https://starwars.fandom.com/wiki/Episode_{media_id}",
+        title_html=f"<i>Star Wars: The Clone Wars</i> — Episode {media_id}",
+        released="2008-10-03",
+        released_html="2008-10-03",
+        watched=False,
+        season="S01",
+        episode="E01",
+        year_sort=-19,
+    )
+    values.update(fields)
+    return CanonMediaEntrySchema(**values)
+
+
+ROWS = [
+    make_row(1, watched=True),
+    # NULLs in every nullable column
+    make_row(
+        2,
+        year=None,
+        year_html=None,
+        content_type=None,
+        content_type_html=None,
+        episode_title=None,
+        episode_url=None,
+        released=None,
+        released_html=None,
+        season="",
+        episode="",
+        year_sort=None,
+    ),
+    make_row(5, title="Ahsoka — “Part Six”", year_sort=0, watched=True),
+    make_row(2**40, year="25,000 BBY", year_sort=-25000),
+]
+
+
+def write(tmp_path, rows=ROWS, compress=False):
+    path = tmp_path / "catalogue.snapshot"
+    write_snapshot(str(path), rows, compress)
+    return path
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_round_trip(tmp_path, compress):
+    path = write(tmp_path, compress=compress)
+    assert read_snapshot(str(path)) == ROWS
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_round_trip_empty(tmp_path, compress):
+    path = write(tmp_path, [], compress)
+    assert read_snapshot(str(path)) == []
+
+
+def test_compressed_is_smaller(tmp_path):
+    rows = [make_row(i) for i in range(1, 200)]
+    plain = write(tmp_path, rows).stat().st_size
+    compressed = write(tmp_path, rows, compress=True).stat().st_size
+    assert compressed < plain
+
+
+def test_unknown_column_is_skipped(tmp_path):
+    # A column from a newer schema, ahead of the known ones
+    data = bytearray(write(tmp_path).read_bytes())
+    magic, count, column_count, flags = HEADER.unpack_from(data)
+    name = b"rating"
+    payload = bytes(count) + bytes(8 * count)
+    extra = COLUMN_NAME.pack(len(name)) + name
+    extra += COLUMN_INFO.pack(KIND_INT, len(payload)) + payload
+    path = tmp_path / "newer.snapshot"
+    path.write_bytes(
+        HEADER.pack(magic, count, column_count + 1, flags) + extra + data[HEADER.size :]
+    )
+    assert read_snapshot(str(path)) == ROWS
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_truncated(tmp_path, compress):
+    data = write(tmp_path, compress=compress).read_bytes()
+    path = tmp_path / "truncated.snapshot"
+    for size in (0, HEADER.size - 1, HEADER.size + 1, HEADER.size + 5):
+        path.write_bytes(data[:size])
+        with pytest.raises(SnapshotError):
+            read_snapshot(str(path))
+    for size in range(len(data) // 2, len(data), 7):
+        path.write_bytes(data[:size])
+        with pytest.raises(SnapshotError):
+            read_snapshot(str(path))
+
+
+def test_bad_magic(tmp_path):
+    data = write(tmp_path).read_bytes()
+    path = tmp_path / "bad.snapshot"
+    path.write_bytes(b"NOTASNAP" + data[8:])
+    with pytest.raises(SnapshotError):
+        read_snapshot(str(path))
+
+
+def test_import_export_preserves_ids_and_watched(tmp_path):
+    source = write(tmp_path)
+    exported = tmp_path / "exported.snapshot"
+
+    async def round_trip():
+        try:
+            imported = await import_snapshot(str(source))
+            exported_count = await export_snapshot(str(exported))
+        finally:
+            await engine.dispose()
+        return imported, exported_count
+
+    imported, exported_count = asyncio.run(round_trip())
+    assert imported == ROWS
+    assert exported_count == len(ROWS)
+    rows = read_snapshot(str(exported))
+    assert [(r.id, r.watched) for r in rows] == [(r.id, r.watched) for r in ROWS]
+    assert rows == ROWS
+
+
+def archived(media_id: int, natural_key: str) -> dict:
+    return dict(
+        id=media_id,
+        title=f"Removed {media_id}",
+        natural_key=natural_key,
+        watched=True,
+        season="",
+        episode="",
+    )
+
+
+def test_import_sorts_rows_and_reconciles_archive(tmp_path):
+    rows = [make_row(5), make_row(1, watched=True), make_row(3)]
+    source = write(tmp_path, rows)
+    row = rows[1]
+    clashing_key = make_natural_key(
+        row.year, row.content_type, row.title, row.episode_title, row.released
+    )
+
+    async def run():
+        try:
+            await migrate(engine)
+            async with engine.begin() as conn:
+                await conn.execute(delete(RemovedMediaEntry))
+                await conn.execute(delete(WatchState))
+                await conn.execute(
+                    insert(RemovedMediaEntry),
+                    [
+                        archived(3, "clashing id"),
+                        archived(8, clashing_key),
+                        archived(9, "still removed"),
+                    ],
+                )
+                await conn.execute(
+                    insert(WatchState),
+                    [dict(user_id="u", media_id=i) for i in (1, 9, 42)],
+                )
+            imported = await import_snapshot(str(source))
+            catalogue = Catalogue()
+            await catalogue.load(imported)
+            served = await catalogue.select(MediaFilter(id_gt=1))
+            async with engine.connect() as conn:
+                archive = (await conn.execute(select(RemovedMediaEntry.id))).scalars()
+                progress = (await conn.execute(select(WatchState.media_id))).scalars()
+                return imported, served, sorted(archive), sorted(progress)
+        finally:
+            await engine.dispose()
+
+    imported, served, archive, progress = asyncio.run(run())
+    assert [r.id for r in imported] == [1, 3, 5]
+    assert [(r.id, r.watched) for r in served] == [(3, False), (5, False)]
+    # Archived rows sharing an id or natural key with the snapshot are gone,
+    # and so is progress on ids that exist nowhere
+    assert archive == [9]
+    assert progress == [1, 9]